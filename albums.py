@@ -0,0 +1,105 @@
+"""Collect messages of one media group (album) to relay them with one call."""
+import asyncio
+import logging
+from collections import OrderedDict
+from functools import partial
+from typing import Awaitable, Callable, Dict, List, Optional
+
+from aiogram import types
+
+log = logging.getLogger(__name__)
+
+SendAlbum = Callable[[List[types.Message], int], Awaitable]
+
+
+class _Group:
+    __slots__ = ('chat_id', 'pchat_id', 'messages', 'timer')
+
+    def __init__(self, chat_id: int, pchat_id: int):
+        self.chat_id = chat_id
+        self.pchat_id = pchat_id
+        self.messages: List[types.Message] = []
+        self.timer: Optional[asyncio.TimerHandle] = None
+
+
+class MediaGroupBuffer:
+    """Buffer messages by `media_group_id` and pass each group to `send`.
+
+    A group is sent `window` seconds after its last message, at once when it
+    has `max_messages` or when a message of another group comes in the chat.
+    At most `max_groups` are buffered, the oldest is sent to make room.
+    Groups of one chat are sent one after another.
+    """
+
+    def __init__(self, send: SendAlbum, window: float = 0.5, max_groups: int = 1000, max_messages: int = 10):
+        self.send = send
+        self.window = window
+        self.max_groups = max_groups
+        self.max_messages = max_messages
+
+        self._groups: Dict[str, _Group] = OrderedDict()
+        self._by_chat: Dict[int, str] = {}
+        self._sending: Dict[int, asyncio.Task] = {}
+
+    def add(self, msg: types.Message, pchat_id: int):
+        """Buffer album message, doesn't wait for sending."""
+        group_id, chat_id = msg.media_group_id, msg.chat.id
+        current = self._by_chat.get(chat_id)
+        if current is not None and current != group_id:
+            self._flush(current)
+
+        group = self._groups.get(group_id)
+        if group is None:
+            if len(self._groups) >= self.max_groups:
+                self._flush(next(iter(self._groups)))
+            group = self._groups[group_id] = _Group(chat_id, pchat_id)
+            self._by_chat[chat_id] = group_id
+        else:
+            group.timer.cancel()
+
+        group.messages.append(msg)
+        if len(group.messages) >= self.max_messages:
+            self._flush(group_id)
+        else:
+            group.timer = asyncio.get_running_loop().call_later(self.window, self._flush, group_id)
+
+    def _flush(self, group_id: str):
+        group = self._groups.pop(group_id, None)
+        if group is None:
+            return
+        if group.timer:
+            group.timer.cancel()
+        del self._by_chat[group.chat_id]
+
+        previous = self._sending.get(group.chat_id)
+        task = self._sending[group.chat_id] = asyncio.create_task(self._send(group, previous))
+        task.add_done_callback(partial(self._sent, group.chat_id))
+
+    def _sent(self, chat_id: int, task: asyncio.Task):
+        if self._sending.get(chat_id) is task:
+            del self._sending[chat_id]
+
+    async def _send(self, group: _Group, previous: Optional[asyncio.Task]):
+        if previous:
+            await asyncio.wait([previous])
+        group.messages.sort(key=lambda m: m.message_id)
+        try:
+            await self.send(group.messages, group.pchat_id)
+        except Exception:
+            log.exception('Cause exception while sending album to %s', group.pchat_id)
+
+    async def flush_chat(self, chat_id: int):
+        """Send buffered album of the chat and wait for it, so the next messages keep order."""
+        group_id = self._by_chat.get(chat_id)
+        if group_id is not None:
+            self._flush(group_id)
+        task = self._sending.get(chat_id)
+        if task:
+            await asyncio.wait([task])
+
+    async def close(self):
+        """Send all buffered albums and wait for them."""
+        for group_id in list(self._groups):
+            self._flush(group_id)
+        if self._sending:
+            await asyncio.wait(list(self._sending.values()))
@@ -0,0 +1,265 @@
+"""Move old documents out of Mongo into compressed files and back.
+
+Documents are streamed through a cursor into gzip files of about
+`chunk_size` documents (JSON lines in canonical extended JSON, or BSON).
+A file is written under a temporary name and renamed when complete, only
+then its documents are deleted, so an interrupted run loses nothing.
+Memory use depends on `chunk_size` and `batch_size`, not on data size.
+
+    python -m archive export projects --status Завершён --older-than 180 --dir archive
+    python -m archive import archive/*.gz
+
+Projects are archived together with their chats, bids and reviews.
+"""
+import argparse
+import asyncio
+import glob
+import gzip
+import itertools
+import logging
+import os
+import time
+from datetime import datetime, timedelta
+from typing import AsyncIterator, Dict, Iterator, List, Optional
+
+import bson
+from bson import ObjectId, json_util
+
+from database_api import BIDS, CHATS, PROJECTS, REVIEWS, MongoDB
+
+log = logging.getLogger(__name__)
+
+JSONL = 'jsonl'
+BSON = 'bson'
+FORMATS = (JSONL, BSON)
+
+# collection: field with id of the project
+PROJECT_RELATED = {CHATS: 'project_id', BIDS: 'project_id', REVIEWS: 'project_id'}
+
+
+def age_filter(older_than_days: float = None, statuses: List[str] = None) -> dict:
+    """Filter documents created more than `older_than_days` ago (by _id) with one of `statuses`."""
+    _filter = {}
+    if older_than_days is not None:
+        created = datetime.utcnow() - timedelta(days=older_than_days)
+        _filter['_id'] = {'$lt': ObjectId.from_datetime(created)}
+    if statuses:
+        _filter['status'] = {'$in': statuses}
+    return _filter
+
+
+class ChunkWriter:
+    """Write documents of one collection into gzip files, a new file is started after `close`."""
+
+    def __init__(self, directory: str, collection: str, run: str, fmt: str = JSONL, chunk_size: int = 100_000):
+        self.directory = directory
+        self.collection = collection
+        self.run = run
+        self.fmt = fmt
+        self.chunk_size = chunk_size
+        self.files: List[str] = []
+
+        self._numbers = itertools.count(1)
+        self._raw = None
+        self._gzip: Optional[gzip.GzipFile] = None
+        self._path: Optional[str] = None
+        self._written = 0
+
+    def write(self, documents: List[dict]):
+        """Write documents to the current file (blocking)."""
+        for document in documents:
+            if self._gzip is None:
+                self._open()
+            if self.fmt == BSON:
+                self._gzip.write(bson.encode(document))
+            else:
+                self._gzip.write(json_util.dumps(document, json_options=json_util.CANONICAL_JSON_OPTIONS).encode())
+                self._gzip.write(b'\n')
+            self._written += 1
+
+    @property
+    def full(self) -> bool:
+        return self._written >= self.chunk_size
+
+    def _open(self):
+        name = f'{self.collection}-{self.run}-{next(self._numbers):05}.{self.fmt}.gz'
+        self._path = os.path.join(self.directory, name)
+        self._raw = open(self._path + '.part', 'wb')
+        self._gzip = gzip.GzipFile(fileobj=self._raw, mode='wb')
+
+    def close(self):
+        """Complete the current file: flush it to disk and give it the final name (blocking)."""
+        if self._gzip is None:
+            return
+        self._gzip.close()
+        self._raw.flush()
+        os.fsync(self._raw.fileno())
+        self._raw.close()
+        os.replace(self._path + '.part', self._path)
+        self.files.append(self._path)
+        self._gzip = self._raw = None
+        self._written = 0
+
+
+def read_file(path: str, batch_size: int) -> Iterator[List[dict]]:
+    """Read documents of an archive file in batches."""
+    with gzip.open(path, 'rb') as f:
+        if path.endswith(f'.{BSON}.gz'):
+            documents = bson.decode_file_iter(f)
+        else:
+            documents = (json_util.loads(line, json_options=json_util.CANONICAL_JSON_OPTIONS) for line in f)
+        while True:
+            batch = list(itertools.islice(documents, batch_size))
+            if not batch:
+                return
+            yield batch
+
+
+def collection_of(path: str) -> str:
+    return os.path.basename(path).split('-', 1)[0]
+
+
+def _report(counts: Dict[str, int], files: List[str], started: float) -> dict:
+    elapsed = time.perf_counter() - started
+    total = sum(counts.values())
+    return {'docs': counts, 'files': files, 'seconds': round(elapsed, 3),
+            'docs_per_sec': round(total / elapsed, 1) if elapsed else 0.0}
+
+
+class Archiver:
+    """Export documents to archive files (optionally deleting them) and import them back."""
+
+    def __init__(self, db: MongoDB, directory: str, fmt: str = JSONL, chunk_size: int = 100_000,
+                 batch_size: int = 1000):
+        if fmt not in FORMATS:
+            raise ValueError(f'Unknown format {fmt}, use one of {FORMATS}')
+        self.db = db
+        self.directory = directory
+        self.fmt = fmt
+        self.chunk_size = chunk_size
+        self.batch_size = batch_size
+
+    async def _batches(self, collection: str, _filter: dict) -> AsyncIterator[List[dict]]:
+        batch = []
+        async for document in self.db.iter_objects(collection, _filter, self.batch_size):
+            batch.append(document)
+            if len(batch) >= self.batch_size:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+
+    async def export(self, collection: str, _filter: dict, delete: bool = False,
+                     related: Dict[str, str] = None) -> dict:
+        """Write documents matching `_filter` to archive files, return counts, files and docs/sec.
+
+        `related` maps other collections to their field referring to the
+        document's id (as str), such documents are archived along.
+        With `delete=True` documents are deleted after their file is complete.
+        """
+        os.makedirs(self.directory, exist_ok=True)
+        run = datetime.utcnow().strftime('%Y%m%d%H%M%S')
+        related = related or {}
+        writers = {c: ChunkWriter(self.directory, c, run, self.fmt, self.chunk_size) for c in [collection, *related]}
+        counts = dict.fromkeys(writers, 0)
+        pending: Dict[str, list] = {c: [] for c in writers}
+        loop = asyncio.get_running_loop()
+        started = time.perf_counter()
+
+        async def write(name: str, documents: List[dict]):
+            await loop.run_in_executor(None, writers[name].write, documents)
+            counts[name] += len(documents)
+            if delete:
+                pending[name].extend(d['_id'] for d in documents)
+
+        async def checkpoint():
+            for writer in writers.values():
+                await loop.run_in_executor(None, writer.close)
+            for name, ids in pending.items():
+                await self.db.delete_objects(name, ids, self.batch_size)
+                ids.clear()
+            log.info('Archived %s, %.1f docs/sec', counts, sum(counts.values()) / (time.perf_counter() - started))
+
+        async for batch in self._batches(collection, _filter):
+            await write(collection, batch)
+            ids = [str(d['_id']) for d in batch]
+            for name, field in related.items():
+                async for documents in self._batches(name, {field: {'$in': ids}}):
+                    await write(name, documents)
+            if writers[collection].full:
+                await checkpoint()
+        await checkpoint()
+
+        files = [path for writer in writers.values() for path in writer.files]
+        return _report(counts, files, started)
+
+    async def archive_projects(self, statuses: List[str], older_than_days: float, delete: bool = True) -> dict:
+        """Archive projects with `statuses` older than `older_than_days` with their chats, bids and reviews."""
+        return await self.export(PROJECTS, age_filter(older_than_days, statuses), delete, PROJECT_RELATED)
+
+    async def import_files(self, paths: List[str]) -> dict:
+        """Insert documents from archive files (collection is taken from file name).
+
+        Documents which already exist are skipped, so import can be repeated.
+        """
+        counts: Dict[str, int] = {}
+        loop = asyncio.get_running_loop()
+        started = time.perf_counter()
+        for path in paths:
+            collection = collection_of(path)
+            batches = read_file(path, self.batch_size)
+            while True:
+                batch = await loop.run_in_executor(None, next, batches, None)
+                if batch is None:
+                    break
+                inserted = await self.db.insert_objects(collection, batch)
+                counts[collection] = counts.get(collection, 0) + inserted
+            log.info('Imported %s', path)
+        return _report(counts, paths, started)
+
+
+async def main(args):
+    db = MongoDB(args.host, args.port, args.db, index=False)
+    archiver = Archiver(db, args.dir, args.format, args.chunk_size, args.batch_size)
+    try:
+        if args.command == 'export':
+            _filter = age_filter(args.older_than, args.status)
+            related = PROJECT_RELATED if args.collection == PROJECTS else None
+            report = await archiver.export(args.collection, _filter, not args.keep, related)
+        else:
+            paths = sorted(path for pattern in args.paths for path in glob.glob(pattern))
+            report = await archiver.import_files(paths)
+    finally:
+        await db.close()
+    for key, value in report.items():
+        print(f'{key}: {value}')
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--host', default='localhost')
+    parser.add_argument('--port', type=int, default=27017)
+    parser.add_argument('--db', default='users')
+    parser.add_argument('--dir', default='archive', help='directory of archive files')
+    parser.add_argument('--format', choices=FORMATS, default=JSONL)
+    parser.add_argument('--chunk-size', type=int, default=100_000, help='documents per file')
+    parser.add_argument('--batch-size', type=int, default=1000, help='documents per read/delete/insert request')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    export = commands.add_parser('export', help='archive documents and delete them')
+    export.add_argument('collection')
+    export.add_argument('--status', action='append', help='status of documents, may be repeated')
+    export.add_argument('--older-than', type=float, help='age of documents in days')
+    export.add_argument('--keep', action='store_true', help='do not delete archived documents')
+
+    import_ = commands.add_parser('import', help='insert documents from archive files')
+    import_.add_argument('paths', nargs='+', help='archive files or glob patterns')
+    args = parser.parse_args()
+    if args.command == 'export' and not args.keep and not (args.status or args.older_than is not None):
+        parser.error('export without --keep needs --status or --older-than')
+    return args
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    asyncio.run(main(parse_args()))
@@ -0,0 +1 @@
+"""Benchmarks, run from the repo root: python -m benchmarks.<name>"""
@@ -0,0 +1,88 @@
+"""Compare data class codec with the previous from_dict / asdict path."""
+import time
+import tracemalloc
+from dataclasses import asdict, fields, make_dataclass
+
+from bson import ObjectId
+
+import data_classes
+
+OBJECTS = 100_000
+
+
+def legacy_resolve(cls, obj_data: dict) -> dict:
+    cls_fields = {f.name for f in fields(cls)}
+    return {key: value for key, value in obj_data.items() if key in cls_fields}
+
+
+def legacy_project(project: dict):
+    obj_data = legacy_resolve(data_classes.Project, project)
+    project_data = legacy_resolve(data_classes.ProjectData, obj_data.pop('data'))
+    return data_classes.Project(**obj_data, data=data_classes.ProjectData(**project_data))
+
+
+def legacy_account(account: dict):
+    obj_data = legacy_resolve(data_classes.Account, account)
+    profile = legacy_resolve(data_classes.Profile, obj_data.pop('profile'))
+    return data_classes.Account(**obj_data, profile=data_classes.Profile(**profile))
+
+
+def make_documents():
+    projects = [{
+        '_id': ObjectId(),
+        'data': {'work_type': 'Курсовая', 'subject': 'Математика', 'date': '01.09',
+                 'description': 'Описание проекта', 'price': 500, 'files': [['photo', 'file_id']]},
+        'status': 'Активен', 'client_id': i, 'worker_id': i + 1, 'post_url': 'https://t.me/c/1/2',
+    } for i in range(OBJECTS)]
+    accounts = [{
+        '_id': i, 'balance': 100, 'subjects': ['Математика', 'Физика'], 'page_url': 'https://t.me/c/1/3',
+        'profile': {'nickname': 'nick', 'phone_number': '380000000000', 'email': 'a@b.c',
+                    'biography': 'bio', 'deals_amount': 3, 'works': ['a', 'b']},
+    } for i in range(OBJECTS)]
+    return projects, accounts
+
+
+def measure(title: str, func, docs: list):
+    start = time.perf_counter()
+    result = [func(d) for d in docs]
+    elapsed = time.perf_counter() - start
+    print(f'{title:<40} {elapsed * 1000:>9.1f} ms')
+    return result
+
+
+def memory(func, docs: list) -> float:
+    tracemalloc.start()
+    result = [func(d) for d in docs]
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del result
+    return size / 2 ** 20
+
+
+def main():
+    projects, accounts = make_documents()
+    print(f'{OBJECTS} objects of each type')
+
+    old_projects = measure('decode Project, legacy', legacy_project, projects)
+    new_projects = measure('decode Project, codec (lazy data)', data_classes.Project.from_dict, projects)
+    measure('decode Project, codec + access data', lambda d: data_classes.Project.from_dict(d).data, projects)
+    old_accounts = measure('decode Account, legacy', legacy_account, accounts)
+    new_accounts = measure('decode Account, codec + access profile',
+                           lambda d: data_classes.Account.from_dict(d).profile, accounts)
+    new_accounts = [data_classes.Account.from_dict(d) for d in accounts]
+
+    encoded = measure('encode Project, asdict', asdict, old_projects)
+    assert encoded == measure('encode Project, to_dict', data_classes.Project.to_dict, new_projects)
+    encoded = measure('encode Account, asdict', asdict, old_accounts)
+    assert encoded == measure('encode Account, to_dict', data_classes.Account.to_dict, new_accounts)
+
+    # the same fields in a class with __dict__, as data classes were before
+    plain_project = make_dataclass('PlainProject', [f.name for f in fields(data_classes.Project)])
+    values = [[getattr(p, f.name) for f in fields(data_classes.Project)] for p in new_projects]
+    with_dict = memory(lambda v: plain_project(*v), values)
+    with_slots = memory(lambda v: data_classes.Project(*v), values)
+    print(f'memory of {OBJECTS} Project instances: __dict__ {with_dict:.1f} MiB, __slots__ {with_slots:.1f} MiB')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,303 @@
+"""Replay synthetic updates through `loader.dp` and the dialog handlers.
+
+Bot API calls go to a local fake server, Mongo is either in-memory
+(`benchmarks.memory_mongo`) or a local mongod (--mongo), which also keeps
+FSM states. Mongo commands are counted by `MemoryClient.commands` or by
+`metrics.MongoListener`.
+config.py must exist, as for the bot itself.
+
+    python -m benchmarks.e2e_bench --updates 5000 --pairs 100
+    python -m benchmarks.e2e_bench --mongo localhost:27017
+
+Results are printed and appended as a JSON line to bench_output.txt.
+"""
+import argparse
+import asyncio
+import collections
+import itertools
+import json
+import os
+import random
+import socket
+import subprocess
+import time
+from typing import Dict, List
+
+from aiohttp import web
+
+from benchmarks.memory_mongo import MemoryClient
+
+UPDATE_KINDS = {
+    'text': 0.45,
+    'reply': 0.15,
+    'edit': 0.1,
+    'pin': 0.05,
+    'photo': 0.07,
+    'album': 0.03,
+    'stop_word': 0.15,
+}
+ALBUM_SIZE = 3
+FIRST_CHAT_ID = -1_000_000_000
+FIRST_USER_ID = 1_000_000
+
+
+class FakeBotAPI:
+    """Answer Bot API requests with plausible results and count them by method."""
+
+    def __init__(self, latency: float = 0.0):
+        self.latency = latency
+        self.calls = collections.Counter()
+        self._message_ids = itertools.count(1_000_000)
+
+    def _message(self, chat_id, text: str = None) -> dict:
+        message = {'message_id': next(self._message_ids), 'date': int(time.time()),
+                   'chat': {'id': int(chat_id), 'type': 'group', 'title': 'pair'}}
+        if text is not None:
+            message['text'] = text
+        return message
+
+    async def handle(self, request: web.Request) -> web.Response:
+        method = request.match_info['method']
+        self.calls[method] += 1
+        params = dict(await request.post())
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        chat_id = params.get('chat_id', 0)
+
+        if method == 'getMe':
+            result = {'id': 123456, 'is_bot': True, 'first_name': 'bench', 'username': 'bench_bot'}
+        elif method == 'sendMediaGroup':
+            result = [self._message(chat_id) for _ in json.loads(params['media'])]
+        elif method == 'exportChatInviteLink':
+            result = f'https://t.me/joinchat/{chat_id}'
+        elif method == 'copyMessage':
+            result = {'message_id': next(self._message_ids)}
+        elif method in ('sendMessage', 'forwardMessage', 'editMessageText'):
+            result = self._message(chat_id, params.get('text', ''))
+        elif method in ('editMessageMedia', 'editMessageCaption'):
+            result = self._message(chat_id)
+        else:
+            result = True
+        return web.json_response({'ok': True, 'result': result})
+
+    async def start(self) -> web.AppRunner:
+        app = web.Application()
+        app.router.add_post('/bot{token}/{method}', self.handle)
+        runner = web.AppRunner(app, access_log=None)
+        await runner.setup()
+        await web.TCPSite(runner, '127.0.0.1', self.port).start()
+        return runner
+
+    @property
+    def port(self) -> int:
+        if not hasattr(self, '_port'):
+            with socket.socket() as s:
+                s.bind(('127.0.0.1', 0))
+                self._port = s.getsockname()[1]
+        return self._port
+
+
+class UpdateStream:
+    """Deterministic updates in pair chats: a chat's users write, reply, edit and pin."""
+
+    def __init__(self, pairs: int, seed: int, stop_word: str):
+        self.random = random.Random(seed)
+        self.stop_word = stop_word
+        self.chat_ids = [FIRST_CHAT_ID - i for i in range(pairs * 2)]
+        self._update_ids = itertools.count(1)
+        self._sent: Dict[int, List[dict]] = {chat_id: [] for chat_id in self.chat_ids}
+
+    def _message(self, chat_id: int, **fields) -> dict:
+        sent = self._sent[chat_id]
+        message = {
+            'message_id': len(sent) + 1,
+            'date': int(time.time()),
+            'chat': {'id': chat_id, 'type': 'group', 'title': 'pair'},
+            'from': {'id': FIRST_USER_ID - chat_id, 'is_bot': False, 'first_name': 'user'},
+            **fields,
+        }
+        sent.append(message)
+        return message
+
+    def _text(self) -> str:
+        return ' '.join(self.random.choice(('привет', 'готово', 'сколько', 'завтра', 'ок')) for _ in range(8))
+
+    def _photo(self, update_id: int) -> list:
+        return [{'file_id': f'photo{update_id}', 'file_unique_id': 'u', 'width': 90, 'height': 90}]
+
+    def make_album(self) -> List[dict]:
+        chat_id = self.random.choice(self.chat_ids)
+        updates = []
+        for _ in range(ALBUM_SIZE):
+            update_id = next(self._update_ids)
+            media_group_id = media_group_id if updates else f'album{update_id}'
+            message = self._message(chat_id, photo=self._photo(update_id), caption=self._text(),
+                                    media_group_id=media_group_id)
+            updates.append({'update_id': update_id, 'message': message})
+        return updates
+
+    def make(self, kind: str) -> dict:
+        chat_id = self.random.choice(self.chat_ids)
+        earlier = self._sent[chat_id]
+        if kind in ('reply', 'edit', 'pin') and not earlier:
+            kind = 'text'
+
+        update = {'update_id': next(self._update_ids)}
+        if kind == 'edit':
+            edited = dict(self.random.choice(earlier), text=self._text(), edit_date=int(time.time()))
+            for key in ('photo', 'caption', 'media_group_id'):
+                edited.pop(key, None)
+            update['edited_message'] = edited
+        elif kind == 'reply':
+            update['message'] = self._message(chat_id, text=self._text(), reply_to_message=self.random.choice(earlier))
+        elif kind == 'pin':
+            update['message'] = self._message(chat_id, pinned_message=self.random.choice(earlier))
+        elif kind == 'photo':
+            update['message'] = self._message(chat_id, photo=self._photo(update['update_id']), caption=self._text())
+        elif kind == 'stop_word':
+            update['message'] = self._message(chat_id, text=f'{self._text()} {self.stop_word}')
+        else:
+            update['message'] = self._message(chat_id, text=self._text())
+        return update
+
+    def generate(self, amount: int) -> List[dict]:
+        kinds, weights = zip(*UPDATE_KINDS.items())
+        updates = []
+        for kind in self.random.choices(kinds, weights, k=amount):
+            if kind == 'album':
+                updates.extend(self.make_album())
+            else:
+                updates.append(self.make(kind))
+        return updates[:amount]
+
+
+def percentile(values: List[float], p: float) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))] if values else 0.0
+
+
+def git_revision() -> str:
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+
+async def run(args) -> dict:
+    api = FakeBotAPI()
+    os.environ['BOT_API_SERVER'] = f'http://127.0.0.1:{api.port}'
+    runner = await api.start()
+
+    from aiogram import Bot, Dispatcher, types
+    from aiogram.contrib.fsm_storage.memory import MemoryStorage
+    from aiogram.contrib.fsm_storage.mongo import MongoStorage
+    from aiogram.dispatcher.middlewares import BaseMiddleware
+    from pymongo import monitoring
+
+    import data_classes
+    import metrics
+    from fsm_storage import TieredStorage
+    from loader import dp, sender, users_db
+    from sender import TokenBucket
+    from texts.misc import STOP_WORDS
+
+    if args.mongo:
+        host, _, port = args.mongo.partition(':')
+        port = int(port or 27017)
+        users_db._host, users_db._port, users_db._db_name = host, port, 'bench'
+        dp.storage = TieredStorage(MongoStorage(host, port, 'bench_fsm'))
+        # for clients created later, of users_db and of the FSM storage
+        monitoring.register(metrics.MongoListener())
+
+        def mongo_commands() -> int:
+            return metrics.MONGO_SECONDS.count
+    else:
+        client = MemoryClient()
+
+        async def get_client():
+            return client
+
+        def mongo_commands() -> int:
+            return sum(client.commands.values())
+
+        users_db._get_client = get_client
+        dp.storage = MemoryStorage()
+
+    if not args.real_limits:
+        # measure the bot, not Telegram flood limits
+        sender.chat_rate = sender.chat_burst = 1e9
+        sender._global = TokenBucket(1e9, 1e9)
+
+    import handlers  # noqa: F401, registers handlers
+
+    latencies = []
+
+    class LatencyMiddleware(BaseMiddleware):
+        async def on_pre_process_update(self, update: types.Update, data: dict):
+            data['started'] = time.perf_counter()
+
+        async def on_post_process_update(self, update: types.Update, results, data: dict):
+            latencies.append(time.perf_counter() - data['started'])
+
+    dp.middleware.setup(LatencyMiddleware())
+    Dispatcher.set_current(dp)
+    Bot.set_current(dp.bot)
+
+    stream = UpdateStream(args.pairs, args.seed, STOP_WORDS[0])
+    for first, second in zip(stream.chat_ids[::2], stream.chat_ids[1::2]):
+        for chat_id, pair_id in ((first, second), (second, first)):
+            chat = data_classes.Chat('project', 'client', FIRST_USER_ID - chat_id, 'link', pair_id, chat_id)
+            await users_db.add_chat(chat)
+    updates = [types.Update(**u) for u in stream.generate(args.updates)]
+
+    api.calls.clear()
+    commands = mongo_commands()
+    started = time.perf_counter()
+    for update in updates:
+        await dp.processor.submit(update)
+    await dp.processor.join()
+    await handlers.dialog.album_buffer.close()
+    elapsed = time.perf_counter() - started
+    commands = mongo_commands() - commands
+
+    await sender.close()
+    await dp.storage.close()
+    await dp.bot.session.close()
+    await runner.cleanup()
+
+    bot_calls = sum(api.calls.values())
+    return {
+        'revision': git_revision(),
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'backend': 'mongod' if args.mongo else 'memory',
+        'updates': args.updates,
+        'pairs': args.pairs,
+        'seed': args.seed,
+        'updates_per_sec': round(args.updates / elapsed, 1),
+        'p50_ms': round(percentile(latencies, 0.5) * 1000, 3),
+        'p99_ms': round(percentile(latencies, 0.99) * 1000, 3),
+        'mongo_commands_per_update': round(commands / args.updates, 3),
+        'bot_calls_per_update': round(bot_calls / args.updates, 3),
+        'bot_calls': dict(api.calls),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--updates', type=int, default=5_000)
+    parser.add_argument('--pairs', type=int, default=100, help='amount of pair chats')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--mongo', help='host:port of a mongod to use instead of in-memory Mongo')
+    parser.add_argument('--real-limits', action='store_true', help='keep Telegram rate limits in the sender')
+    parser.add_argument('--output', default='bench_output.txt')
+    args = parser.parse_args()
+
+    result = asyncio.run(run(args))
+    for key, value in result.items():
+        print(f'{key}: {value}')
+    with open(args.output, 'a') as f:
+        f.write(json.dumps(result, ensure_ascii=False) + '\n')
+
+
+if __name__ == '__main__':
+    main()
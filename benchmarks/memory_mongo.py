@@ -0,0 +1,282 @@
+"""Minimal in-memory stand-in for a motor client, for benchmarks.
+
+Supports the subset of the collection API used by `database_api` on the
+hot paths: insert/find/update/delete with equality, $in, $exists and
+comparison filters, $set/$inc/$unset/$push updates, insert_many and
+bulk_write of InsertOne/UpdateOne/DeleteOne, other operators (including
+top-level ones like $or and $text) raise NotImplementedError. Lookups by
+_id are dict lookups, so it adds almost no cost of its own (unlike
+mongomock, which scans collections). `MemoryClient.commands` counts calls
+by method, as a real server would count commands.
+"""
+import collections
+import copy
+from types import SimpleNamespace
+from typing import Dict, List, Optional
+
+from bson import ObjectId
+from pymongo.errors import BulkWriteError
+
+_COMPARISONS = {
+    '$gt': lambda a, b: a is not None and a > b,
+    '$gte': lambda a, b: a is not None and a >= b,
+    '$lt': lambda a, b: a is not None and a < b,
+    '$lte': lambda a, b: a is not None and a <= b,
+    '$ne': lambda a, b: a != b,
+    '$in': lambda a, b: any(_equals(a, v) for v in b),
+    '$exists': lambda a, b: (a is not _MISSING) == b,
+}
+_MISSING = object()
+
+
+def _get(doc: dict, path: str):
+    for key in path.split('.'):
+        if isinstance(doc, list) and key.isdigit():
+            doc = doc[int(key)] if int(key) < len(doc) else _MISSING
+        elif isinstance(doc, dict):
+            doc = doc.get(key, _MISSING)
+        else:
+            return _MISSING
+    return doc
+
+
+def _equals(value, expected) -> bool:
+    if isinstance(value, list) and not isinstance(expected, list):
+        return expected in value
+    return value == expected
+
+
+def _matches(doc: dict, _filter: dict) -> bool:
+    for path, condition in _filter.items():
+        if path.startswith('$'):
+            raise NotImplementedError(f'Query operator {path} is not supported by memory_mongo')
+        value = _get(doc, path)
+        if isinstance(condition, dict) and condition and all(k.startswith('$') for k in condition):
+            for operator, operand in condition.items():
+                if operator not in _COMPARISONS:
+                    raise NotImplementedError(f'Query operator {operator} is not supported by memory_mongo')
+                if not _COMPARISONS[operator](None if value is _MISSING and operator != '$exists' else value, operand):
+                    return False
+        elif not _equals(None if value is _MISSING else value, condition):
+            return False
+    return True
+
+
+def _set(doc: dict, path: str, value):
+    *parents, key = path.split('.')
+    for parent in parents:
+        doc = doc.setdefault(parent, {})
+    doc[key] = value
+
+
+def _apply(doc: dict, update: dict):
+    if isinstance(update, list):
+        raise NotImplementedError('Pipeline updates are not supported by memory_mongo')
+    for operator, fields in update.items():
+        for path, value in fields.items():
+            if operator == '$set':
+                _set(doc, path, copy.deepcopy(value))
+            elif operator == '$inc':
+                current = _get(doc, path)
+                _set(doc, path, (0 if current is _MISSING else current) + value)
+            elif operator == '$unset':
+                *parents, key = path.split('.')
+                parent = _get(doc, '.'.join(parents)) if parents else doc
+                if isinstance(parent, dict):
+                    parent.pop(key, None)
+            elif operator == '$push':
+                current = _get(doc, path)
+                _set(doc, path, ([] if current is _MISSING else current) + [copy.deepcopy(value)])
+            else:
+                raise NotImplementedError(f'Update operator {operator} is not supported by memory_mongo')
+
+
+def _project(doc: dict, projection: Optional[dict]) -> dict:
+    doc = copy.deepcopy(doc)
+    if not projection:
+        return doc
+    include = {k for k, v in projection.items() if v and k != '_id'}
+    if not include:
+        return {k: v for k, v in doc.items() if projection.get(k, 1)}
+    result = {'_id': doc['_id']} if projection.get('_id', 1) and '_id' in doc else {}
+    for path in include:
+        value = _get(doc, path)
+        if value is not _MISSING:
+            _set(result, path, value)
+    return result
+
+
+class _BulkRecorder:
+    """Receive pymongo bulk operations (InsertOne, UpdateOne, ...) from `op._add_to_bulk`.
+
+    pymongo has no public way to read an operation, `_add_to_bulk` is the
+    private hook of its own bulk API, so this may need changes with pymongo.
+    """
+
+    def __init__(self):
+        self.operations = []
+
+    def add_insert(self, document: dict):
+        self.operations.append(('insert', document))
+
+    def add_update(self, selector: dict, update: dict, multi: bool, upsert: bool, **_):
+        if multi:
+            raise NotImplementedError('UpdateMany is not supported by memory_mongo')
+        self.operations.append(('update', selector, update, upsert))
+
+    def add_replace(self, selector: dict, replacement: dict, upsert: bool, **_):
+        raise NotImplementedError('ReplaceOne is not supported by memory_mongo')
+
+    def add_delete(self, selector: dict, limit: int, **_):
+        if limit != 1:
+            raise NotImplementedError('DeleteMany is not supported by memory_mongo')
+        self.operations.append(('delete', selector))
+
+
+class MemoryCursor:
+    def __init__(self, docs: List[dict]):
+        self._docs = iter(docs)
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self) -> dict:
+        try:
+            return next(self._docs)
+        except StopIteration:
+            raise StopAsyncIteration
+
+
+class MemoryCollection:
+    def __init__(self, name: str, commands: collections.Counter):
+        self.name = name
+        self._docs: Dict[object, dict] = {}
+        self._commands = commands
+
+    def _find(self, _filter: dict) -> List[dict]:
+        if '_id' in _filter and not isinstance(_filter['_id'], dict):
+            doc = self._docs.get(_filter['_id'])
+            return [doc] if doc is not None and _matches(doc, _filter) else []
+        return [doc for doc in self._docs.values() if _matches(doc, _filter)]
+
+    async def insert_one(self, doc: dict):
+        self._commands['insert'] += 1
+        return self._insert_one(doc)
+
+    def _insert_one(self, doc: dict):
+        doc = copy.deepcopy(doc)
+        doc.setdefault('_id', ObjectId())
+        if doc['_id'] in self._docs:
+            raise KeyError(f'Duplicate _id {doc["_id"]}')
+        self._docs[doc['_id']] = doc
+        return SimpleNamespace(inserted_id=doc['_id'])
+
+    async def insert_many(self, docs: List[dict], ordered=True):
+        self._commands['insert'] += 1
+        errors = []
+        inserted = 0
+        for index, doc in enumerate(docs):
+            doc.setdefault('_id', ObjectId())
+            try:
+                self._insert_one(doc)
+            except KeyError as e:
+                errors.append({'index': index, 'code': 11000, 'errmsg': str(e)})
+                if ordered:
+                    break
+            else:
+                inserted += 1
+        if errors:
+            raise BulkWriteError({'writeErrors': errors, 'nInserted': inserted})
+        return SimpleNamespace(inserted_ids=[doc['_id'] for doc in docs])
+
+    async def find_one(self, _filter: dict = None, projection: dict = None) -> Optional[dict]:
+        self._commands['find'] += 1
+        found = self._find(_filter or {})
+        return _project(found[0], projection) if found else None
+
+    def find(self, _filter: dict = None, projection: dict = None, sort=None, limit=0, **_) -> MemoryCursor:
+        self._commands['find'] += 1
+        found = self._find(_filter or {})
+        for key, direction in reversed(sort or []):
+            found.sort(key=lambda d: _get(d, key), reverse=direction < 0)
+        if limit:
+            found = found[:limit]
+        return MemoryCursor([_project(doc, projection) for doc in found])
+
+    def _update_one(self, _filter: dict, update: dict, upsert: bool):
+        found = self._find(_filter)
+        if found:
+            _apply(found[0], update)
+        elif upsert:
+            doc = {k: v for k, v in _filter.items() if not isinstance(v, dict)}
+            _apply(doc, update)
+            doc.setdefault('_id', ObjectId())
+            self._docs[doc['_id']] = doc
+
+    async def update_one(self, _filter: dict, update: dict, upsert=False):
+        self._commands['update'] += 1
+        self._update_one(_filter, update, upsert)
+
+    async def bulk_write(self, requests: list, ordered=True):
+        # one command per kind of operations, as pymongo sends them
+        recorder = _BulkRecorder()
+        for request in requests:
+            request._add_to_bulk(recorder)
+        for kind in {kind for kind, *_ in recorder.operations}:
+            self._commands[kind] += 1
+        for kind, *args in recorder.operations:
+            if kind == 'insert':
+                self._insert_one(*args)
+            elif kind == 'update':
+                self._update_one(*args)
+            else:
+                self._delete_one(*args)
+
+    async def delete_one(self, _filter: dict):
+        self._commands['delete'] += 1
+        self._delete_one(_filter)
+
+    def _delete_one(self, _filter: dict):
+        found = self._find(_filter)
+        if found:
+            del self._docs[found[0]['_id']]
+
+    async def count_documents(self, _filter: dict) -> int:
+        self._commands['aggregate'] += 1
+        return len(self._find(_filter))
+
+    async def index_information(self) -> dict:
+        self._commands['listIndexes'] += 1
+        return {'_id_': {'key': [('_id', 1)]}}
+
+    async def create_indexes(self, models: list):
+        self._commands['createIndexes'] += 1
+
+
+class MemoryDatabase:
+    def __init__(self, name: str, commands: collections.Counter):
+        self.name = name
+        self._collections: Dict[str, MemoryCollection] = {}
+        self._commands = commands
+
+    def __getitem__(self, name: str) -> MemoryCollection:
+        collection = self._collections.get(name)
+        if collection is None:
+            collection = self._collections[name] = MemoryCollection(name, self._commands)
+        return collection
+
+
+class MemoryClient:
+    def __init__(self):
+        self._databases: Dict[str, MemoryDatabase] = {}
+        # command name: amount
+        self.commands = collections.Counter()
+
+    def get_database(self, name: str) -> MemoryDatabase:
+        database = self._databases.get(name)
+        if database is None:
+            database = self._databases[name] = MemoryDatabase(name, self.commands)
+        return database
+
+    def close(self):
+        pass
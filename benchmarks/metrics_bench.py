@@ -0,0 +1,88 @@
+"""Measure overhead of `metrics` instrumentation per update.
+
+    python -m benchmarks.metrics_bench
+"""
+import asyncio
+import time
+import timeit
+from types import SimpleNamespace
+
+from aiogram import Bot, Dispatcher, types
+
+import metrics
+
+UPDATES = 20_000
+OBSERVES = 1_000_000
+
+
+def make_update(i: int) -> types.Update:
+    return types.Update(**{
+        'update_id': i,
+        'message': {
+            'message_id': i, 'date': 0, 'text': 'hello',
+            'chat': {'id': i % 100, 'type': 'group'},
+            'from': {'id': i % 100, 'is_bot': False, 'first_name': 'user'},
+        },
+    })
+
+
+async def pair_chat(*_):
+    return {'pchat_id': 1}
+
+
+async def handler(msg: types.Message, pchat_id: int):
+    pass
+
+
+async def dispatch(dp: Dispatcher, updates) -> float:
+    started = time.perf_counter()
+    for update in updates:
+        await dp.updates_handler.notify(update)
+    return (time.perf_counter() - started) / len(updates) * 1e6
+
+
+async def dispatch_overhead():
+    bot = Bot('123456:' + 'a' * 35)
+    updates = [make_update(i) for i in range(UPDATES)]
+
+    dp = Dispatcher(bot)
+    dp.register_message_handler(handler, pair_chat)
+    await dispatch(dp, updates[:1000])
+    disabled = await dispatch(dp, updates)
+
+    metrics.setup(dp)
+    await dispatch(dp, updates[:1000])
+    enabled = await dispatch(dp, updates)
+    await bot.session.close()
+
+    print(f'dispatch, metrics disabled: {disabled:.1f} us/update')
+    print(f'dispatch, metrics enabled:  {enabled:.1f} us/update (+{enabled - disabled:.1f} us)')
+
+
+def mongo_listener_overhead():
+    listener = metrics.MongoListener()
+    started = SimpleNamespace(command={'find': 'projects'}, command_name='find', connection_id=1, request_id=1)
+    succeeded = SimpleNamespace(command_name='find', connection_id=1, request_id=1, duration_micros=500)
+
+    def command():
+        listener.started(started)
+        listener.succeeded(succeeded)
+
+    seconds = timeit.timeit(command, number=OBSERVES)
+    print(f'mongo listener: {seconds / OBSERVES * 1e9:.0f} ns/command')
+
+
+def observe_overhead():
+    child = metrics.Histogram('bench_seconds', 'Benchmark.').labels()
+    seconds = timeit.timeit(lambda: child.observe(0.003), number=OBSERVES)
+    print(f'histogram observe: {seconds / OBSERVES * 1e9:.0f} ns')
+
+
+def main():
+    observe_overhead()
+    mongo_listener_overhead()
+    asyncio.run(dispatch_overhead())
+
+
+if __name__ == '__main__':
+    main()
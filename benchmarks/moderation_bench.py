@@ -0,0 +1,64 @@
+"""Compare `moderation.Moderator` with the old per-word loop."""
+import random
+import re
+import string
+import timeit
+
+from moderation import Moderator
+from texts.misc import STOP_WORDS
+
+MESSAGES = 200
+REPEAT = 5
+
+
+def old_check(text: str, username: str, stop_words: list):
+    lower_msg_text = text.lower()
+    for word in stop_words:
+        if word.lower() in lower_msg_text:
+            return 'stop_word'
+    if username and username.lower() in lower_msg_text:
+        return 'username'
+    elif re.search(r'(380)?[0-9-–() ]{9,}', lower_msg_text):
+        return 'phone'
+    return None
+
+
+def make_words(amount: int) -> list:
+    words = list(STOP_WORDS)
+    alphabet = 'абвгдежзиклмнопрстуфхцчшщыэюя' + string.ascii_lowercase
+    while len(words) < amount:
+        words.append(''.join(random.choices(alphabet, k=random.randint(5, 12))))
+    return words[:amount]
+
+
+def make_messages() -> list:
+    alphabet = 'абвгдежзиклмнопрстуфхцчшщыэюя   '
+    return [''.join(random.choices(alphabet, k=random.randint(20, 400))) for _ in range(MESSAGES)]
+
+
+def check_phone_words():
+    """Stop words starting with phone characters must not be hidden by a phone."""
+    words = ['(050)', '12-34', 'ок']
+    moderator = Moderator(words)
+    for msg in ('позвони 1234567 (050) ок', 'позвони 1234567 (050)', '12-34 56 78 90', '123 456 789 0', 'ок', ''):
+        assert old_check(msg, 'user', words) == moderator.check(msg, 'user'), msg
+
+
+def main():
+    random.seed(0)
+    messages = make_messages()
+    check_phone_words()
+    print(f'{"words":>6} {"loop, ms":>10} {"engine, ms":>11} {"speedup":>8}  ({MESSAGES} messages)')
+    for amount in (60, 1_000, 10_000):
+        words = make_words(amount)
+        moderator = Moderator(words)
+        for msg in messages:
+            assert old_check(msg, 'user', words) == moderator.check(msg, 'user')
+
+        old = min(timeit.repeat(lambda: [old_check(m, 'user', words) for m in messages], number=1, repeat=REPEAT))
+        new = min(timeit.repeat(lambda: [moderator.check(m, 'user') for m in messages], number=1, repeat=REPEAT))
+        print(f'{amount:>6} {old * 1000:>10.2f} {new * 1000:>11.2f} {old / new:>7.1f}x')
+
+
+if __name__ == '__main__':
+    main()
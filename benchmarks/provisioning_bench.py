@@ -0,0 +1,137 @@
+"""Compare `provisioning.provision_pairs` with the sequential call chain per pair.
+
+Bot API calls go to a local fake server answering after --api-latency
+seconds, Mongo is in-memory with --mongo-latency seconds per operation
+(a round trip) or a local mongod (--mongo).
+config.py must exist, as for the bot itself.
+
+    python -m benchmarks.provisioning_bench --pairs 500
+    python -m benchmarks.provisioning_bench --mongo localhost:27017 --mongo-latency 0
+
+Results are printed and appended as a JSON line to bench_output.txt.
+"""
+import argparse
+import asyncio
+import json
+import os
+import time
+
+from benchmarks.e2e_bench import FIRST_CHAT_ID, FakeBotAPI, git_revision
+from benchmarks.memory_mongo import MemoryClient
+
+STATUS = 'В работе'
+
+
+async def run(args) -> dict:
+    api = FakeBotAPI(args.api_latency)
+    os.environ['BOT_API_SERVER'] = f'http://127.0.0.1:{api.port}'
+    runner = await api.start()
+
+    import data_classes
+    import provisioning
+    from loader import bot, sender, users_db
+    from sender import TokenBucket
+
+    if args.mongo:
+        host, _, port = args.mongo.partition(':')
+        users_db._host, users_db._port, users_db._db_name = host, int(port or 27017), 'bench'
+    else:
+        client = MemoryClient()
+
+        async def get_client():
+            return client
+
+        users_db._get_client = get_client
+
+    if not args.real_limits:
+        # measure provisioning, not Telegram flood limits
+        sender.chat_rate = sender.chat_burst = 1e9
+        sender._global = TokenBucket(1e9, 1e9)
+
+    db_calls = 0
+    get_db = users_db.get_db
+
+    async def counting_get_db():
+        nonlocal db_calls
+        db_calls += 1
+        if args.mongo_latency:
+            await asyncio.sleep(args.mongo_latency)
+        return await get_db()
+
+    users_db.get_db = counting_get_db
+
+    chat_ids = iter(range(FIRST_CHAT_ID, FIRST_CHAT_ID - 10 ** 9, -1))
+
+    async def make_pairs():
+        pairs = []
+        for i in range(args.pairs):
+            data = data_classes.ProjectData('work', 'subject', 'date', 'text')
+            project = data_classes.Project(data, 'Активен', i)
+            project_id = await users_db.add_project(project)
+            pairs.append(provisioning.Pair(project_id, i, i + 1, next(chat_ids), next(chat_ids)))
+        return pairs
+
+    async def sequential(pairs):
+        for pair in pairs:
+            client_link = await bot.export_chat_invite_link(pair.client_chat_id)
+            worker_link = await bot.export_chat_invite_link(pair.worker_chat_id)
+            await users_db.add_chat(data_classes.Chat(pair.project_id, 'client', pair.client_id, client_link,
+                                                      pair.worker_chat_id, pair.client_chat_id))
+            await users_db.add_chat(data_classes.Chat(pair.project_id, 'worker', pair.worker_id, worker_link,
+                                                      pair.client_chat_id, pair.worker_chat_id))
+            await users_db.update_project_chats(pair.project_id, pair.client_chat_id, pair.worker_chat_id)
+            await users_db.update_project_worker(pair.project_id, pair.worker_id)
+            await users_db.update_project_status(pair.project_id, STATUS)
+
+    async def batched(pairs):
+        results = await provisioning.provision_pairs(pairs, STATUS, args.concurrency)
+        assert all(r.ok for r in results), [r.error for r in results if not r.ok][:5]
+
+    result = {
+        'revision': git_revision(),
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'benchmark': 'provisioning',
+        'backend': 'mongod' if args.mongo else 'memory',
+        'pairs': args.pairs,
+        'concurrency': args.concurrency,
+        'api_latency': args.api_latency,
+        'mongo_latency': args.mongo_latency,
+    }
+    for name, provision in (('sequential', sequential), ('batched', batched)):
+        pairs = await make_pairs()
+        db_calls = 0
+        api.calls.clear()
+        started = time.perf_counter()
+        await provision(pairs)
+        elapsed = time.perf_counter() - started
+        result[f'{name}_pairs_per_sec'] = round(args.pairs / elapsed, 1)
+        result[f'{name}_mongo_ops'] = db_calls
+        result[f'{name}_bot_calls'] = sum(api.calls.values())
+
+    await sender.close()
+    await bot.session.close()
+    await users_db.close()
+    await runner.cleanup()
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--pairs', type=int, default=500)
+    parser.add_argument('--concurrency', type=int, default=20, help='concurrent Bot API calls of provision_pairs')
+    parser.add_argument('--api-latency', type=float, default=0.05, help='seconds per Bot API call')
+    parser.add_argument('--mongo-latency', type=float, default=0.001, help='seconds per Mongo operation')
+    parser.add_argument('--real-limits', action='store_true', help='keep Telegram rate limits in the sender')
+    parser.add_argument('--mongo', help='host:port of a mongod to use instead of in-memory Mongo')
+    parser.add_argument('--output', default='bench_output.txt')
+    args = parser.parse_args()
+
+    result = asyncio.run(run(args))
+    for key, value in result.items():
+        print(f'{key}: {value}')
+    with open(args.output, 'a') as f:
+        f.write(json.dumps(result, ensure_ascii=False) + '\n')
+
+
+if __name__ == '__main__':
+    main()
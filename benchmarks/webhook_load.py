@@ -0,0 +1,92 @@
+"""Post synthetic updates to a webhook and report updates/sec.
+
+Start the bot first, e.g. with a fake Bot API server:
+    BOT_API_SERVER=http://127.0.0.1:8081 python webhook.py --workers 4
+    python -m benchmarks.webhook_load --url http://127.0.0.1:8080/ --updates 20000
+Repeat with different --workers to compare.
+
+Updates are posted to pair chats which are first added to the bot's Mongo
+(--mongo, --db), so every update is relayed to the partner chat.
+"""
+import argparse
+import asyncio
+import itertools
+import random
+import time
+
+from aiohttp import ClientSession, TCPConnector
+
+import data_classes
+from database_api import CHATS, MongoDB
+
+FIRST_CHAT_ID = -1_000_000
+FIRST_USER_ID = 1_000_000
+
+
+def make_update(update_id: int, chat_id: int) -> dict:
+    return {
+        'update_id': update_id,
+        'message': {
+            'message_id': update_id,
+            'date': int(time.time()),
+            'chat': {'id': chat_id, 'type': 'group', 'title': 'bench'},
+            'from': {'id': FIRST_USER_ID - chat_id, 'is_bot': False, 'first_name': 'bench'},
+            'text': f'message {update_id}',
+        },
+    }
+
+
+async def add_pair_chats(chat_ids: list, host: str, port: int, db_name: str):
+    """Link chats in pairs (existing ones are kept)."""
+    db = MongoDB(host, port, db_name, index=False)
+    documents = []
+    for first, second in zip(chat_ids[::2], chat_ids[1::2]):
+        for chat_id, pair_id in ((first, second), (second, first)):
+            chat = data_classes.Chat('project', 'client', FIRST_USER_ID - chat_id, 'link', pair_id, chat_id)
+            documents.append(chat.to_dict())
+    try:
+        await db.insert_objects(CHATS, documents)
+    finally:
+        await db.close()
+
+
+async def run(url: str, updates: int, chats: int, concurrency: int, mongo: str, db_name: str):
+    chat_ids = [FIRST_CHAT_ID - i for i in range(chats - chats % 2)]
+    host, _, port = mongo.partition(':')
+    await add_pair_chats(chat_ids, host, int(port or 27017), db_name)
+    ids = itertools.count(1)
+    errors = 0
+
+    async def post_many(session: ClientSession):
+        nonlocal errors
+        while True:
+            update_id = next(ids)
+            if update_id > updates:
+                return
+            async with session.post(url, json=make_update(update_id, random.choice(chat_ids))) as resp:
+                if resp.status != 200:
+                    errors += 1
+
+    async with ClientSession(connector=TCPConnector(limit=concurrency)) as session:
+        start = time.perf_counter()
+        await asyncio.gather(*(post_many(session) for _ in range(concurrency)))
+        elapsed = time.perf_counter() - start
+
+    print(f'updates: {updates}, chats: {chats}, concurrency: {concurrency}, errors: {errors}')
+    print(f'{updates / elapsed:.0f} updates/sec ({elapsed:.2f} s)')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--url', default='http://127.0.0.1:8080/')
+    parser.add_argument('--updates', type=int, default=10_000)
+    parser.add_argument('--chats', type=int, default=200, help='amount of pair chats (even)')
+    parser.add_argument('--concurrency', type=int, default=64)
+    parser.add_argument('--mongo', default='localhost:27017', help='host:port of the mongod used by the bot')
+    parser.add_argument('--db', default='users', help='database used by the bot')
+    args = parser.parse_args()
+    asyncio.run(run(args.url, args.updates, args.chats, args.concurrency, args.mongo, args.db))
+
+
+if __name__ == '__main__':
+    main()
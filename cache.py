@@ -0,0 +1,60 @@
+"""In-process caches."""
+import time
+from collections import OrderedDict
+from typing import Any, Hashable
+
+MISSING = object()
+
+
+class TTLCache:
+    """Bounded LRU cache with per-entry time to live.
+
+    `None` is a valid value, so negative results (e.g. "not a pair chat")
+    may be cached too. Use `MISSING` to check for absent keys.
+    """
+
+    def __init__(self, maxsize: int = 10_000, ttl: float = 300):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._data: OrderedDict = OrderedDict()
+
+    def get(self, key: Hashable, default=MISSING) -> Any:
+        """Return cached value or `default`, count hit or miss."""
+        item = self._data.get(key, MISSING)
+        if item is not MISSING:
+            value, expires = item
+            if expires > time.monotonic():
+                self._data.move_to_end(key)
+                self.hits += 1
+                return value
+            del self._data[key]
+        self.misses += 1
+        return default
+
+    def set(self, key: Hashable, value: Any):
+        self._data[key] = (value, time.monotonic() + self.ttl)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def pop(self, key: Hashable, default=None) -> Any:
+        item = self._data.pop(key, MISSING)
+        if item is MISSING:
+            return default
+        return item[0]
+
+    def clear(self):
+        self._data.clear()
+
+    def stats(self) -> dict:
+        return {
+            'size': len(self._data),
+            'maxsize': self.maxsize,
+            'hits': self.hits,
+            'misses': self.misses,
+        }
+
+    def __len__(self):
+        return len(self._data)
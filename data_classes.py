@@ -1,14 +1,142 @@
 """Contain all data classes."""
 from __future__ import annotations
 
-from dataclasses import dataclass, field, fields
-from typing import List, Optional, Union
+from dataclasses import MISSING, dataclass, field, fields
+from datetime import datetime
+from functools import lru_cache
+from typing import Callable, List, Union
 
 from bson import ObjectId
 
 
+class _NotLoaded:
+    """Value of fields which were not requested (see projections in database_api)."""
+
+    def __repr__(self):
+        return 'NOT_LOADED'
+
+    def __bool__(self):
+        return False
+
+
+NOT_LOADED = _NotLoaded()
+
+
+class _PartialDict(dict):
+    """Data of nested object, which was loaded with projection."""
+
+
+class Nested:
+    """Field with nested data class, decoded from dict on first access."""
+
+    def __init__(self, data_cls: type, default=NOT_LOADED):
+        self.data_cls = data_cls
+        self.default = default
+
+    def __set_name__(self, owner, name):
+        self.name = name
+        self.storage = f'_{name}_value'
+
+    def __get__(self, instance, owner=None):
+        if instance is None:
+            if self.default is NOT_LOADED:
+                raise AttributeError(self.name)  # dataclass field without default
+            return self.default
+        value = getattr(instance, self.storage)
+        if isinstance(value, dict):
+            value = self.data_cls.from_dict(value, partial=isinstance(value, _PartialDict))
+            setattr(instance, self.storage, value)
+        return value
+
+    def __set__(self, instance, value):
+        setattr(instance, self.storage, value)
+
+
+def slotted(cls):
+    """Recreate data class with __slots__, like dataclass(slots=True) in python 3.10+."""
+    cls_dict = dict(cls.__dict__)
+    slots = []
+    for f in fields(cls):
+        attr = cls_dict.get(f.name)
+        if isinstance(attr, Nested):
+            slots.append(attr.storage)
+        else:
+            slots.append(f.name)
+            cls_dict.pop(f.name, None)
+    cls_dict['__slots__'] = tuple(slots)
+    cls_dict.pop('__dict__', None)
+    cls_dict.pop('__weakref__', None)
+
+    new_cls = type(cls)(cls.__name__, cls.__bases__, cls_dict)
+    new_cls.__qualname__ = cls.__qualname__
+    return new_cls
+
+
+@lru_cache(maxsize=None)
+def _field_names(cls) -> frozenset:
+    return frozenset(f.name for f in fields(cls))
+
+
+def _compile(source: str, name: str, namespace: dict) -> Callable:
+    exec(source, namespace)
+    return namespace[name]
+
+
+@lru_cache(maxsize=None)
+def _decoder(cls) -> Callable[[dict], DataType]:
+    """Generate function building instance from dict without __init__ and extra checks."""
+    namespace = {'cls': cls, 'new': object.__new__}
+    lines = ['def decode(d):', '    obj = new(cls)']
+    for f in fields(cls):
+        attr = cls.__dict__.get(f.name)
+        target = attr.storage if isinstance(attr, Nested) else f.name
+        if f.default is not MISSING:
+            namespace[f'_dflt_{f.name}'] = f.default
+            lines.append(f'    obj.{target} = d.get({f.name!r}, _dflt_{f.name})')
+        elif f.default_factory is not MISSING:
+            namespace[f'_fact_{f.name}'] = f.default_factory
+            lines.append(f'    obj.{target} = d[{f.name!r}] if {f.name!r} in d else _fact_{f.name}()')
+        else:
+            lines.append(f'    obj.{target} = d[{f.name!r}]')
+    lines.append('    return obj')
+    decode = _compile('\n'.join(lines), 'decode', namespace)
+
+    def decode_checked(obj_data: dict):
+        try:
+            return decode(obj_data)
+        except KeyError as e:
+            raise TypeError(f'{cls.__name__} missing required field {e}') from None
+
+    return decode_checked
+
+
+def _encode_value(value):
+    if isinstance(value, DataType):
+        return value.to_dict()
+    return value
+
+
+@lru_cache(maxsize=None)
+def _encoder(cls) -> Callable[[DataType], dict]:
+    """Generate function returning the same dict as dataclasses.asdict.
+
+    Containers (lists) are not deep copied.
+    """
+    namespace = {'value': _encode_value}
+    items = []
+    for f in fields(cls):
+        if isinstance(cls.__dict__.get(f.name), Nested) or (
+                isinstance(globals().get(f.type), type) and issubclass(globals()[f.type], DataType)):
+            items.append(f'{f.name!r}: value(obj.{f.name})')
+        else:
+            items.append(f'{f.name!r}: obj.{f.name}')
+    source = 'def encode(obj):\n    return {' + ', '.join(items) + '}'
+    return _compile(source, 'encode', namespace)
+
+
 @dataclass
 class DataType:
+    __slots__ = ()
 
     @property
     def id(self) -> Union[str, int, None]:
@@ -27,7 +155,7 @@ class DataType:
 
     @classmethod
     def _resolve_fields(cls, obj_data: dict) -> dict:
-        cls_fields = {f.name for f in fields(cls)}
+        cls_fields = _field_names(cls)
         resolved_data = {}
         for key, value in obj_data.items():
             if key in cls_fields:
@@ -35,19 +163,40 @@ class DataType:
         return resolved_data
 
     @classmethod
-    def from_dict(cls, obj_data: dict):
-        """Exclude extra items, return instance if data provided else None."""
+    def _fill_not_loaded(cls, obj_data: dict) -> dict:
+        """Mark absent fields as NOT_LOADED, nested data as partial."""
+        for f in fields(cls):
+            value = obj_data.get(f.name, NOT_LOADED)
+            if isinstance(value, dict) and isinstance(cls.__dict__.get(f.name), Nested):
+                value = _PartialDict(value)
+            obj_data[f.name] = value
+        return obj_data
+
+    @classmethod
+    def from_dict(cls, obj_data: dict, partial=False):
+        """Exclude extra items, return instance if data provided else None.
+
+        Nested data classes are decoded on first access. With [partial=True]
+        absent fields are set to NOT_LOADED instead of raising TypeError.
+        """
         if cls is DataType:
             err_text = f'This method is only for {cls.__name__} subclasses'
             raise AttributeError(err_text)
 
         if obj_data:
-            obj_data = cls._resolve_fields(obj_data)
+            if not partial:
+                return _decoder(cls)(obj_data)
+            obj_data = cls._fill_not_loaded(cls._resolve_fields(obj_data))
             # noinspection PyArgumentList
             return cls(**obj_data)
         return None
 
+    def to_dict(self) -> dict:
+        """Return BSON-ready dict, same as dataclasses.asdict but without deep copy."""
+        return _encoder(self.__class__)(self)
 
+
+@slotted
 @dataclass
 class Profile(DataType):
     nickname: str
@@ -58,24 +207,19 @@ class Profile(DataType):
     works: list = field(default_factory=list)
 
 
+@slotted
 @dataclass
 class Account(DataType):
+    # balance as of balance_until, MongoDB.get_balance returns the current one
     balance: int = 0
     subjects: list = field(default_factory=list)
-    profile: Profile = None
+    profile: Profile = Nested(Profile, default=None)
     page_url: str = None
+    balance_until: datetime = None
     _id: int = None
 
-    @classmethod
-    def from_dict(cls, account: dict) -> Optional[Account]:
-        if account:
-            obj_data = cls._resolve_fields(account)
-            profile_data = obj_data.pop('profile', None)
-            profile = Profile.from_dict(profile_data)
-            return cls(**obj_data, profile=profile)
-        return None
-
 
+@slotted
 @dataclass
 class Bid(DataType):
     client_id: int
@@ -85,6 +229,7 @@ class Bid(DataType):
     _id: ObjectId = None
 
 
+@slotted
 @dataclass
 class Chat(DataType):
     project_id: str
@@ -95,12 +240,14 @@ class Chat(DataType):
     _id: int = None
 
 
+@slotted
 @dataclass
 class PairChats(DataType):
     client_chat: Chat
     worker_chat: Chat
 
 
+@slotted
 @dataclass
 class ProjectData(DataType):
     work_type: str
@@ -112,9 +259,10 @@ class ProjectData(DataType):
     files: List[list] = field(default_factory=list)
 
 
+@slotted
 @dataclass
 class Project(DataType):
-    data: ProjectData
+    data: ProjectData = Nested(ProjectData)
     status: str
     client_id: int
     worker_id: int = None
@@ -123,16 +271,8 @@ class Project(DataType):
     worker_chat_id: int = None
     _id: ObjectId = None
 
-    @classmethod
-    def from_dict(cls, project: dict) -> Optional[Project]:
-        if project:
-            obj_data = cls._resolve_fields(project)
-            project_data = obj_data.pop('data', None)
-            project_data = ProjectData.from_dict(project_data)
-            return cls(**obj_data, data=project_data)
-        return None
-
 
+@slotted
 @dataclass
 class Rating(DataType):
     quality: int
@@ -140,21 +280,41 @@ class Rating(DataType):
     terms: int
 
 
+@slotted
 @dataclass
 class Review(DataType):
     client_id: int
     client_name: str
     worker_id: int
     project_id: str
-    rating: Rating
+    rating: Rating = Nested(Rating)
     text: str
     _id: ObjectId = None
 
-    @classmethod
-    def from_dict(cls, review: dict) -> Optional[Review]:
-        if review:
-            obj_data = cls._resolve_fields(review)
-            rating_data = obj_data.pop('rating', None)
-            rating = Rating.from_dict(rating_data)
-            return cls(**obj_data, rating=rating)
-        return None
+
+@slotted
+@dataclass
+class WorkerRating(DataType):
+    """Sums of worker's review ratings and the last reviews' ratings (recent)."""
+    count: int = 0
+    quality: int = 0
+    contact: int = 0
+    terms: int = 0
+    recent: list = field(default_factory=list)
+    score: float = 0.0
+    _id: int = None
+
+    def mean(self, criterion: str) -> float:
+        """Average of 'quality', 'contact' or 'terms'."""
+        return getattr(self, criterion) / self.count if self.count else 0.0
+
+
+@slotted
+@dataclass
+class LedgerEntry(DataType):
+    """Change of account's balance, _id is an idempotency key (generated if None)."""
+    account_id: int
+    amount: int
+    reason: str = None
+    date: datetime = None
+    _id: str = None
@@ -1,14 +1,24 @@
 """Класс для асинхронной работы с MongoDB"""
 
-from dataclasses import asdict
-from typing import List, Optional, Union
-
+import asyncio
+import logging
+import time
+from contextlib import asynccontextmanager
+from contextvars import ContextVar
+from datetime import datetime, timedelta
+from functools import partial
+from typing import AsyncIterator, Dict, Iterable, List, Optional, Set, Tuple, Union
+
+import bson
 from aiogram.utils.helper import Helper
 from bson import ObjectId
 from motor.motor_asyncio import AsyncIOMotorClient, AsyncIOMotorDatabase
+from pymongo import ASCENDING, DESCENDING, TEXT, CursorType, DeleteOne, IndexModel, UpdateOne
+from pymongo.errors import BulkWriteError, CollectionInvalid, OperationFailure
 from pymongo.results import InsertOneResult
 
 import data_classes
+from cache import MISSING, TTLCache
 
 ACCOUNTS = 'accounts'
 PROJECTS = 'projects'
@@ -16,21 +26,311 @@ BIDS = 'bids'
 CHATS = 'chats'
 REVIEWS = 'reviews'
 WITHDRAWALS = 'withdrawals'
+MESSAGES = 'messages'
+RATINGS = 'ratings'
+INVALIDATIONS = 'invalidations'
+LEDGER = 'ledger'
+LEDGER_STATE = 'ledger_state'
+
+MESSAGES_TTL = 30 * 24 * 60 * 60
+INVALIDATIONS_SIZE = 1024 * 1024
+RECENT_RATINGS = 10
+# записи журнала моложе LEDGER_GRACE секунд не сворачиваются в снимок баланса
+LEDGER_GRACE = 60
+DUPLICATE_KEY = 11000
+
+# коллекции, документы которых кэшируются целиком по _id
+CACHED_COLLECTIONS = (ACCOUNTS, PROJECTS)
+
+log = logging.getLogger(__name__)
 
 
 class Indexes(Helper):
-    PROJECTS = (PROJECTS, ['client_id', 'worker_id', 'data.subject'])
-    BIDS = (BIDS, ['client_id', 'worker_id'])
+    """Индексы коллекций: (коллекция, [IndexModel, ...])."""
+    ACCOUNTS = (ACCOUNTS, [IndexModel('subjects')])
+    PROJECTS = (PROJECTS, [
+        # также для фильтра по client_id/worker_id и страниц get_projects_page_by_user
+        IndexModel([('client_id', ASCENDING), ('_id', DESCENDING)]),
+        IndexModel([('worker_id', ASCENDING), ('_id', DESCENDING)]),
+        IndexModel('data.subject'),
+        # get_projects_by_subjects(only_active=True)
+        IndexModel([('status', ASCENDING), ('data.subject', ASCENDING)]),
+        # search_projects
+        IndexModel([('status', ASCENDING), ('_id', DESCENDING)]),
+        IndexModel([('data.description', TEXT), ('data.subject', TEXT), ('data.work_type', TEXT)],
+                   weights={'data.subject': 5, 'data.work_type': 3}, default_language='russian',
+                   name='projects_text'),
+    ])
+    # project_id: выгрузка связанных документов в archive.py
+    BIDS = (BIDS, [IndexModel('client_id'), IndexModel('worker_id'), IndexModel('project_id')])
+    CHATS = (CHATS, [IndexModel('project_id')])
+    REVIEWS = (REVIEWS, [IndexModel('project_id')])
+    RATINGS = (RATINGS, [IndexModel('score')])
+    MESSAGES = (MESSAGES, [IndexModel('date', expireAfterSeconds=MESSAGES_TTL)])
+    # get_balance и compact_balances
+    LEDGER = (LEDGER, [IndexModel([('account_id', ASCENDING), ('date', ASCENDING)]), IndexModel('date')])
+
+
+# опции, отличие которых означает другой индекс
+_INDEX_OPTIONS = ('unique', 'sparse', 'expireAfterSeconds', 'partialFilterExpression')
+
+
+def _index_exists(model: IndexModel, existing: dict) -> bool:
+    """Проверяет, есть ли среди index_information() индекс с теми же ключами и опциями."""
+    document = model.document
+    keys = list(document['key'].items())
+    if TEXT in document['key'].values():
+        # ключи текстового индекса хранятся как _fts/_ftsx, сравниваем по имени
+        return document['name'] in existing
+    for info in existing.values():
+        if [tuple(k) for k in info['key']] == keys and \
+                all(info.get(o) == document.get(o) for o in _INDEX_OPTIONS):
+            return True
+    return False
+
+
+RATING_CRITERIA = ('quality', 'contact', 'terms')
+
+# поля проекта для списка результатов поиска
+SEARCH_FIELDS = ['status', 'data.work_type', 'data.subject', 'data.date', 'data.price']
+PRICE_FACETS = [0, 500, 1000, 2000, 5000, 10_000]
+
+
+class SearchSort(Helper):
+    RELEVANCE = 'relevance'
+    RECENT = 'recent'
+
+
+# среднее по всем критериям
+_SCORE_EXPR = {'$divide': [{'$add': [f'${c}' for c in RATING_CRITERIA]},
+                           {'$multiply': ['$count', len(RATING_CRITERIA)]}]}
+
+
+def _rating_update(rating: dict) -> list:
+    """Конвейер обновления агрегата рейтинга исполнителя одной новой оценкой (атомарно, с upsert)."""
+    inc = {field: {'$add': [{'$ifNull': [f'${field}', 0]}, rating[field]]} for field in RATING_CRITERIA}
+    recent = {'$concatArrays': [{'$ifNull': ['$recent', []]}, [rating]]}
+    return [
+        {'$set': {'count': {'$add': [{'$ifNull': ['$count', 0]}, 1]}, **inc,
+                  'recent': {'$slice': [recent, -RECENT_RATINGS]}}},
+        {'$set': {'score': _SCORE_EXPR}},
+    ]
+
+
+def _date_range(since: Optional[datetime], until: Optional[datetime]) -> dict:
+    date = {}
+    if since:
+        date['$gte'] = since
+    if until:
+        date['$lt'] = until
+    return {'date': date} if date else {}
+
+
+def _check_duplicates(e: BulkWriteError):
+    """Пропускает ошибки повторного ключа, остальные поднимает."""
+    if any(error['code'] != DUPLICATE_KEY for error in e.details['writeErrors']):
+        raise e
+
+
+def _filter_id(_filter: dict):
+    """Возвращает _id, если фильтр только по _id (без операторов), иначе MISSING."""
+    if list(_filter) == ['_id'] and not isinstance(_filter['_id'], dict):
+        return _filter['_id']
+    return MISSING
+
+
+def _projection(fields: Optional[List[str]]) -> Optional[dict]:
+    """Проекция для списка полей: ['status', 'data.subject'] -> {'status': 1, 'data.subject': 1}."""
+    return {f: 1 for f in fields} if fields else None
+
+
+class _Update:
+    """Одно обновление документа, собранное из нескольких операций."""
+
+    def __init__(self, _filter: dict, upsert: bool):
+        self.filter = _filter
+        self.upsert = upsert
+        self.operators: Dict[str, dict] = {}
+
+    def merge(self, operator: str, update: dict) -> bool:
+        """Добавляет операцию, возвращает False, если она конфликтует с добавленными."""
+        for path in update:
+            for other_operator, other_update in self.operators.items():
+                for other in other_update:
+                    if path == other and operator == other_operator and operator in ('$set', '$inc'):
+                        continue
+                    if path == other or path.startswith(f'{other}.') or other.startswith(f'{path}.'):
+                        return False
+
+        target = self.operators.setdefault(operator, {})
+        for path, value in update.items():
+            if operator == '$inc' and path in target:
+                target[path] += value
+            else:
+                target[path] = value
+        return True
+
+
+class UnitOfWork:
+    """Накапливает обновления и отправляет их одним bulk_write на коллекцию.
+
+    Операции над одним документом (фильтр только по _id) объединяются в одно обновление.
+    """
+
+    def __init__(self):
+        self._updates: Dict[str, List[_Update]] = {}
+        self._last: Dict[tuple, _Update] = {}
+
+    def __len__(self):
+        return sum(len(u) for u in self._updates.values())
+
+    def add(self, collection: str, _filter: dict, operator: str, update: dict, upsert=True):
+        _id = _filter_id(_filter)
+        key = (collection, _id) if _id is not MISSING else None
+        last = self._last.get(key) if key else None
+        if last is None or last.upsert != upsert or not last.merge(operator, update):
+            last = _Update(_filter, upsert)
+            last.merge(operator, update)
+            self._updates.setdefault(collection, []).append(last)
+            if key:
+                self._last[key] = last
+
+    def filters(self) -> Iterable[Tuple[str, dict]]:
+        """Возвращает (коллекция, фильтр) всех накопленных обновлений."""
+        for collection, collection_updates in self._updates.items():
+            for u in collection_updates:
+                yield collection, u.filter
+
+    async def flush(self, db: AsyncIOMotorDatabase):
+        updates, self._updates, self._last = self._updates, {}, {}
+        for collection, collection_updates in updates.items():
+            requests = [UpdateOne(u.filter, u.operators, upsert=u.upsert) for u in collection_updates]
+            await db[collection].bulk_write(requests, ordered=True)
+
+
+_current_batch: ContextVar[Optional[UnitOfWork]] = ContextVar('current_batch', default=None)
+
+
+class SubjectIndex:
+    """Инвертированный индекс: предмет -> id аккаунтов с этим предметом."""
+
+    def __init__(self):
+        self.loaded = False
+        # time.monotonic(), после которого индекс нужно перезагрузить
+        self.expires = 0.0
+        self._accounts: Dict[str, Set[int]] = {}
+        self._subjects: Dict[int, Set[str]] = {}
+        # предметы аккаунтов, изменённых во время загрузки
+        self._touched: Optional[Dict[int, Set[str]]] = None
+
+    def set(self, account_id: int, subjects: Iterable[str]):
+        """Заменяет предметы аккаунта."""
+        new = set(subjects)
+        if self._touched is not None:
+            self._touched[account_id] = new
+        self._replace(account_id, new)
+
+    def _replace(self, account_id: int, new: Set[str]):
+        old = self._subjects.pop(account_id, set())
+        for subject in old - new:
+            ids = self._accounts[subject]
+            ids.discard(account_id)
+            if not ids:
+                del self._accounts[subject]
+        for subject in new - old:
+            self._accounts.setdefault(subject, set()).add(account_id)
+        if new:
+            self._subjects[account_id] = new
+
+    def remove(self, account_id: int):
+        self.set(account_id, ())
+
+    def get(self, subject: str) -> Set[int]:
+        """Возвращает копию множества id аккаунтов с предметом."""
+        return set(self._accounts.get(subject, ()))
+
+    def is_expired(self) -> bool:
+        return not self.loaded or self.expires <= time.monotonic()
+
+    def expire(self):
+        """Индекс перезагрузится при следующем MongoDB.get_subject_index."""
+        self.expires = 0.0
+
+    async def load(self, accounts: AsyncIterator[dict], ttl: float):
+        """(Пере)заполняет индекс, не затирая аккаунты, изменённые во время загрузки.
+
+        До конца загрузки get возвращает прежние данные.
+        """
+        self._touched = {}
+        try:
+            loaded = SubjectIndex()
+            async for account in accounts:
+                loaded._replace(account['_id'], set(account.get('subjects') or ()))
+            for account_id, subjects in self._touched.items():
+                loaded._replace(account_id, subjects)
+        finally:
+            self._touched = None
+        self._accounts, self._subjects = loaded._accounts, loaded._subjects
+        self.loaded = True
+        self.expires = time.monotonic() + ttl
+
+    def __len__(self):
+        return len(self._subjects)
 
 
 class MongoClient:
     """Содержит методы управления MongoDB клиентом."""
 
-    def __init__(self, host='localhost', port=27017, db_name='users', index=True):
+    def __init__(self, host='localhost', port=27017, db_name='users', index=True,
+                 chats_cache_size=10_000, chats_cache_ttl=300, messages_cache_size=50_000, flush_window=0.0,
+                 entities_cache_size=10_000, entities_cache_ttl=60, invalidation_channel=False,
+                 max_pool_size=100, min_pool_size=0, server_selection_timeout=30.0, connect_timeout=20.0,
+                 socket_timeout: float = None, ledger_compaction_interval=0.0, subject_index_ttl=300,
+                 **client_options):
+        """Документы accounts и projects кэшируются в entities_cache (read-through).
+
+        С invalidation_channel=True изменения рассылаются другим процессам
+        через capped коллекцию invalidations.
+        Индекс предметов перезагружается раз в subject_index_ttl секунд, так как
+        аккаунты меняют и процессы без invalidation_channel.
+        С ledger_compaction_interval > 0 журнал балансов сворачивается в снимки
+        каждые ledger_compaction_interval секунд.
+        Таймауты в секундах, client_options передаются в AsyncIOMotorClient.
+        """
         self._host = host
         self._port = port
         self._db_name = db_name
         self._index = index
+        self._client_options = {
+            'maxPoolSize': max_pool_size,
+            'minPoolSize': min_pool_size,
+            'serverSelectionTimeoutMS': int(server_selection_timeout * 1000),
+            'connectTimeoutMS': int(connect_timeout * 1000),
+            'socketTimeoutMS': int(socket_timeout * 1000) if socket_timeout else None,
+            **client_options,
+        }
+        self._init_lock: Optional[asyncio.Lock] = None
+        self._flush_window = flush_window
+        self._window: Optional[UnitOfWork] = None
+        self._window_flushed: Optional[asyncio.Future] = None
+
+        self.chats_cache = TTLCache(chats_cache_size, chats_cache_ttl)
+        self.messages_cache = TTLCache(messages_cache_size, MESSAGES_TTL)
+        self.entities_cache = TTLCache(entities_cache_size, entities_cache_ttl)
+        self._loads: Dict[tuple, asyncio.Future] = {}
+
+        self._invalidation_channel = invalidation_channel
+        self._source_id = ObjectId()
+        self._listener: Optional[asyncio.Task] = None
+
+        self._compaction_interval = ledger_compaction_interval
+        self._compactor: Optional[asyncio.Task] = None
+
+        self.subject_index = SubjectIndex()
+        self._subject_index_ttl = subject_index_ttl
+        self._subject_index_lock: Optional[asyncio.Lock] = None
+        # фоновые задачи, ссылки на них нужны до завершения
+        self._tasks: Set[asyncio.Task] = set()
 
         self._mongo: Optional[AsyncIOMotorClient] = None
         self._db: Optional[AsyncIOMotorDatabase] = None
@@ -40,28 +340,112 @@ class MongoClient:
             return self._mongo
 
         uri = f'mongodb://{self._host}:{self._port}'
-        self._mongo = AsyncIOMotorClient(uri)
+        self._mongo = AsyncIOMotorClient(uri, **self._client_options)
         return self._mongo
 
     async def get_db(self) -> AsyncIOMotorDatabase:
-        if isinstance(self._db, AsyncIOMotorDatabase):
+        """Возвращает базу, при первом вызове (один раз для всех конкурентных) подключается и создаёт индексы."""
+        if self._db is not None:
             return self._db
 
-        mongo = await self._get_client()
-        self._db = mongo.get_database(self._db_name)
-
-        if self._index:
-            await self.apply_index(self._db)
+        if self._init_lock is None:
+            self._init_lock = asyncio.Lock()
+        async with self._init_lock:
+            if self._db is not None:
+                return self._db
+
+            mongo = await self._get_client()
+            db = mongo.get_database(self._db_name)
+            if self._index:
+                await self.apply_index(db)
+            if self._invalidation_channel:
+                await self._start_listener(db)
+            self._db = db
         return self._db
 
     @staticmethod
     async def apply_index(db):
-        for index in Indexes.all():
-            collection, fields = index
-            for field in fields:
-                await db[collection].create_index(keys=[(field, 1)], background=True)
+        """Создаёт недостающие индексы из Indexes, коллекции обрабатываются параллельно."""
+        async def apply(collection: str, models: List[IndexModel]):
+            existing = await db[collection].index_information()
+            missing = [m for m in models if not _index_exists(m, existing)]
+            if not missing:
+                return
+            try:
+                await db[collection].create_indexes(missing)
+            except OperationFailure as e:
+                # например, индекс с теми же ключами, но другими опциями: менять его нужно вручную
+                log.warning('Cannot create indexes of %s: %s', collection, e)
+            else:
+                log.info('Created indexes of %s: %s', collection, [m.document['name'] for m in missing])
+
+        await asyncio.gather(*[apply(collection, models) for collection, models in Indexes.all()])
+
+    async def _start_listener(self, db: AsyncIOMotorDatabase):
+        try:
+            await db.create_collection(INVALIDATIONS, capped=True, size=INVALIDATIONS_SIZE)
+        except CollectionInvalid:
+            pass
+        self._listener = asyncio.create_task(self._listen(db))
+
+    async def _listen(self, db: AsyncIOMotorDatabase):
+        """Читает инвалидации других процессов из capped коллекции (tailable cursor).
+
+        Сообщения читаются в порядке вставки (_id разных процессов не монотонны),
+        новые - после своего маркера. Маркер также не даёт курсору по пустой
+        коллекции сразу закрыться.
+        """
+        while True:
+            result = await db[INVALIDATIONS].insert_one({'source': self._source_id, 'keys': []})
+            cursor = db[INVALIDATIONS].find(cursor_type=CursorType.TAILABLE_AWAIT)
+            started = False
+            try:
+                async for message in cursor:
+                    if not started:
+                        started = message['_id'] == result.inserted_id
+                        continue
+                    if message['source'] != self._source_id:
+                        for collection, _id in message['keys']:
+                            self._drop(collection, _id)
+                            if collection == ACCOUNTS and self.subject_index.loaded:
+                                self._run_task(self._refresh_subjects(db, _id))
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                log.exception('Cause exception while reading invalidations.')
+            # пока курсор открывается заново, сообщения могут быть пропущены
+            self._clear_caches()
+            await asyncio.sleep(1)
+
+    def _run_task(self, coro):
+        task = asyncio.ensure_future(coro)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _refresh_subjects(self, db: AsyncIOMotorDatabase, account_id: int):
+        account = await db[ACCOUNTS].find_one({'_id': account_id}, {'subjects': 1})
+        self.subject_index.set(account_id, (account.get('subjects') or ()) if account else ())
+
+    def _clear_caches(self):
+        self.chats_cache.clear()
+        self.entities_cache.clear()
+        self._loads.clear()
+        self.subject_index.expire()
+
+    def _drop(self, collection: str, _id):
+        """Удаляет документ из локальных кэшей и отменяет сохранение загружаемого сейчас."""
+        if collection == CHATS:
+            self.chats_cache.pop(_id)
+        elif collection in CACHED_COLLECTIONS:
+            self.entities_cache.pop((collection, _id))
+            self._loads.pop((collection, _id), None)
 
     async def close(self):
+        if self._listener:
+            self._listener.cancel()
+            self._listener = None
+        for task in list(self._tasks):
+            task.cancel()
         if self._mongo:
             self._mongo.close()
 
@@ -75,111 +459,497 @@ class MongoBase(MongoClient):
         if object_data.get('_id') is None:
             object_data.pop('_id', None)
         result: InsertOneResult = await db[collection].insert_one(object_data)
+        await self._invalidate([(collection, {'_id': result.inserted_id})])
         return str(result.inserted_id)
 
-    async def get_object(self, collection: str, _filter: dict,
-                         many=False) -> Union[dict, List[dict], None]:
-        """Возвращает из коллекции объект, список объектов [many=True] или None."""
+    async def get_object(self, collection: str, _filter: dict, many=False,
+                         projection: dict = None) -> Union[dict, List[dict], None]:
+        """Возвращает из коллекции объект, список объектов [many=True] или None.
+
+        С projection возвращаются только указанные поля (и _id).
+        """
         db = await self.get_db()
         if many:
-            result = [obj async for obj in db[collection].find(_filter) if obj]
+            result = [obj async for obj in db[collection].find(_filter, projection) if obj]
         else:
-            result = await db[collection].find_one(_filter)
+            result = await db[collection].find_one(_filter, projection)
         return result
 
+    async def get_cached_object(self, collection: str, _id) -> Optional[dict]:
+        """Возвращает документ по _id через entities_cache (в т.ч. отсутствие).
+
+        Одновременные промахи по одному _id ждут один запрос. Возвращается копия,
+        её можно изменять.
+        """
+        key = (collection, _id)
+        raw = self.entities_cache.get(key)
+        if raw is MISSING:
+            load = self._loads.get(key)
+            if load is None:
+                load = self._loads[key] = asyncio.ensure_future(self._load_object(collection, _id))
+                load.add_done_callback(partial(self._store_object, key))
+            raw = await asyncio.shield(load)
+        return bson.decode(raw) if raw is not None else None
+
+    async def _load_object(self, collection: str, _id) -> Optional[bytes]:
+        obj = await self.get_object(collection, {'_id': _id})
+        return bson.encode(obj) if obj is not None else None
+
+    def _store_object(self, key: tuple, load: asyncio.Future):
+        # загрузка, прерванная инвалидацией, уже удалена из _loads
+        if self._loads.get(key) is not load:
+            return
+        del self._loads[key]
+        if not load.cancelled() and load.exception() is None:
+            self.entities_cache.set(key, load.result())
+
+    async def _invalidate(self, filters: Iterable[Tuple[str, dict]]):
+        """Сбрасывает кэши для изменённых документов (и сообщает другим процессам)."""
+        keys = []
+        for collection, _filter in filters:
+            if collection not in CACHED_COLLECTIONS and collection != CHATS:
+                continue
+            _id = _filter_id(_filter)
+            if _id is not MISSING:
+                self._drop(collection, _id)
+                keys.append((collection, _id))
+            else:
+                # изменённые документы неизвестны
+                if collection == CHATS:
+                    self.chats_cache.clear()
+                else:
+                    for key in [k for k in self._loads if k[0] == collection]:
+                        self._drop(*key)
+                    self.entities_cache.clear()
+
+        if keys and self._invalidation_channel:
+            db = await self.get_db()
+            await db[INVALIDATIONS].insert_one({'source': self._source_id, 'keys': keys})
+
+    async def iter_objects(self, collection: str, _filter: dict, batch_size=100, sort: List[Tuple[str, int]] = None,
+                           limit=0, projection: dict = None) -> AsyncIterator[dict]:
+        """Итерирует объекты коллекции по курсору, получая их пачками по batch_size."""
+        db = await self.get_db()
+        cursor = db[collection].find(_filter, projection, sort=sort, limit=limit, batch_size=batch_size)
+        async for obj in cursor:
+            yield obj
+
+    async def get_page(self, collection: str, _filter: dict, after=None, limit=20,
+                       descending=True, projection: dict = None) -> List[dict]:
+        """Возвращает страницу объектов, отсортированных по _id, следующих за _id after (без skip)."""
+        if after is not None:
+            _filter = {**_filter, '_id': {'$lt' if descending else '$gt': after}}
+        sort = [('_id', DESCENDING if descending else ASCENDING)]
+        return [obj async for obj in self.iter_objects(collection, _filter, limit, sort, limit, projection)]
+
+    async def aggregate(self, collection: str, pipeline: List[dict], **kwargs) -> List[dict]:
+        """Выполняет конвейер агрегации, возвращает список документов."""
+        db = await self.get_db()
+        return [obj async for obj in db[collection].aggregate(pipeline, **kwargs)]
+
     async def delete_object(self, collection: str, _filter: dict):
         """Удаляет объект из коллекции."""
         db = await self.get_db()
         await db[collection].delete_one(_filter)
+        await self._invalidate([(collection, _filter)])
+
+    async def insert_objects(self, collection: str, objects: List[dict]) -> int:
+        """Добавляет объекты одним insert_many, объекты с уже существующим _id пропускаются.
+
+        Возвращает число добавленных.
+        """
+        if not objects:
+            return 0
+        db = await self.get_db()
+        try:
+            result = await db[collection].insert_many(objects, ordered=False)
+        except BulkWriteError as e:
+            _check_duplicates(e)
+            inserted = e.details['nInserted']
+        else:
+            inserted = len(result.inserted_ids)
+        await self._invalidate([(collection, {'_id': obj['_id']}) for obj in objects if '_id' in obj])
+        return inserted
+
+    async def delete_objects(self, collection: str, ids: list, batch_size=1000):
+        """Удаляет объекты по _id пачками bulk_write."""
+        db = await self.get_db()
+        for i in range(0, len(ids), batch_size):
+            batch = ids[i:i + batch_size]
+            await db[collection].bulk_write([DeleteOne({'_id': _id}) for _id in batch], ordered=False)
+            await self._invalidate([(collection, {'_id': _id}) for _id in batch])
 
     async def update_object(self, collection: str, _filter: dict, operator: str, update: dict, upsert=True):
-        """Обновляет элемент коллекции, может создать новый элемент при [upsert=True]."""
+        """Обновляет элемент коллекции, может создать новый элемент при [upsert=True].
+
+        Внутри batch() обновление откладывается до конца блока, при flush_window > 0
+        объединяется с другими обновлениями за flush_window секунд.
+        """
+        batch = _current_batch.get()
+        if batch is not None:
+            batch.add(collection, _filter, operator, update, upsert)
+        elif self._flush_window:
+            await self._update_in_window(collection, _filter, operator, update, upsert)
+        else:
+            db = await self.get_db()
+            await db[collection].update_one(_filter, {operator: update}, upsert)
+            await self._invalidate([(collection, _filter)])
+
+    @asynccontextmanager
+    async def batch(self) -> AsyncIterator[UnitOfWork]:
+        """Собирает обновления внутри блока и отправляет их при выходе (если не было исключения)."""
+        if _current_batch.get() is not None:
+            yield _current_batch.get()
+            return
+
+        uow = UnitOfWork()
+        token = _current_batch.set(uow)
+        try:
+            yield uow
+        finally:
+            _current_batch.reset(token)
+        await self.flush(uow)
+
+    async def flush(self, uow: UnitOfWork):
         db = await self.get_db()
-        await db[collection].update_one(_filter, {operator: update}, upsert)
+        filters = list(uow.filters())
+        await uow.flush(db)
+        await self._invalidate(filters)
+
+    async def _update_in_window(self, collection: str, _filter: dict, operator: str, update: dict, upsert: bool):
+        if self._window is None:
+            self._window = UnitOfWork()
+            self._window_flushed = asyncio.get_running_loop().create_future()
+            asyncio.get_running_loop().call_later(self._flush_window, self._run_task, self._flush_in_window())
+        self._window.add(collection, _filter, operator, update, upsert)
+        await asyncio.shield(self._window_flushed)
+
+    async def _flush_in_window(self):
+        uow, flushed = self._window, self._window_flushed
+        self._window = self._window_flushed = None
+        try:
+            await self.flush(uow)
+        except asyncio.CancelledError:
+            flushed.cancel()
+            raise
+        except Exception as e:
+            flushed.set_exception(e)
+        else:
+            flushed.set_result(None)
 
 
 class MongoAdder(MongoBase):
     """Содержит методы для добавления объектов в коллекции."""
 
     async def add_project(self, project: data_classes.Project) -> str:
-        return await self.add_object(PROJECTS, asdict(project))
+        return await self.add_object(PROJECTS, project.to_dict())
 
     async def add_bid(self, bid: data_classes.Bid) -> str:
-        return await self.add_object(BIDS, asdict(bid))
+        return await self.add_object(BIDS, bid.to_dict())
 
     async def add_chat(self, chat: data_classes.Chat) -> str:
-        return await self.add_object(CHATS, asdict(chat))
+        return await self.add_object(CHATS, chat.to_dict())
+
+    async def add_chats(self, chats: List[data_classes.Chat]) -> List[int]:
+        """Добавляет группы одним insert_many, возвращает id групп, которые уже были в базе (не добавлены)."""
+        if not chats:
+            return []
+        documents = [chat.to_dict() for chat in chats]
+        existing = []
+        db = await self.get_db()
+        try:
+            await db[CHATS].insert_many(documents, ordered=False)
+        except BulkWriteError as e:
+            _check_duplicates(e)
+            existing = [documents[error['index']]['_id'] for error in e.details['writeErrors']]
+        await self._invalidate([(CHATS, {'_id': document['_id']}) for document in documents])
+        return existing
 
     async def add_review(self, review: data_classes.Review) -> str:
-        return await self.add_object(REVIEWS, asdict(review))
+        """Добавляет отзыв и учитывает его оценку в рейтинге исполнителя."""
+        review_id = await self.add_object(REVIEWS, review.to_dict())
+        rating = {field: getattr(review.rating, field) for field in RATING_CRITERIA}
+        db = await self.get_db()
+        await db[RATINGS].update_one({'_id': review.worker_id}, _rating_update(rating), upsert=True)
+        return review_id
+
+    async def rebuild_worker_ratings(self):
+        """Пересчитывает все рейтинги исполнителей по отзывам (для уже существующих данных)."""
+        db = await self.get_db()
+        pipeline = [
+            {'$sort': {'_id': ASCENDING}},
+            {'$group': {
+                '_id': '$worker_id',
+                'count': {'$sum': 1},
+                **{field: {'$sum': f'$rating.{field}'} for field in RATING_CRITERIA},
+                'recent': {'$push': {field: f'$rating.{field}' for field in RATING_CRITERIA}},
+            }},
+            {'$set': {'recent': {'$slice': ['$recent', -RECENT_RATINGS]}, 'score': _SCORE_EXPR}},
+            {'$merge': {'into': RATINGS, 'whenMatched': 'replace', 'whenNotMatched': 'insert'}},
+        ]
+        async for _ in db[REVIEWS].aggregate(pipeline, allowDiskUse=True):
+            pass
+
+    async def add_message_pair(self, chat_id: int, message_id: int, pair_chat_id: int, pair_message_id: int):
+        """Запоминает соответствие сообщений в связанных группах (в обе стороны)."""
+        self.messages_cache.set((chat_id, message_id), pair_message_id)
+        self.messages_cache.set((pair_chat_id, pair_message_id), message_id)
+
+        date = datetime.utcnow()
+        requests = [
+            UpdateOne({'_id': f'{chat_id}:{message_id}'},
+                      {'$set': {'pair_message_id': pair_message_id, 'date': date}}, upsert=True),
+            UpdateOne({'_id': f'{pair_chat_id}:{pair_message_id}'},
+                      {'$set': {'pair_message_id': message_id, 'date': date}}, upsert=True),
+        ]
+        db = await self.get_db()
+        await db[MESSAGES].bulk_write(requests, ordered=False)
 
 
 class MongoGetter(MongoBase):
-    """Содержит методы для поиска объектов в коллекциях."""
-
-    async def get_all_accounts(self) -> List[data_classes.Account]:
-        accounts = []
-        for a in await self.get_object(ACCOUNTS, {}, many=True):
-            account = data_classes.Account.from_dict(a)
-            accounts.append(account)
-        return accounts
-
-    async def get_all_projects(self) -> List[data_classes.Project]:
-        projects = []
-        for p in await self.get_object(PROJECTS, {}, many=True):
-            project = data_classes.Project.from_dict(p)
-            projects.append(project)
-        return projects
-
-    async def get_project_by_id(self, project_id: str) -> Optional[data_classes.Project]:
-        _filter = {'_id': ObjectId(project_id)}
-        project_dict = await self.get_object(PROJECTS, _filter)
-        return data_classes.Project.from_dict(project_dict)
+    """Содержит методы для поиска объектов в коллекциях.
 
-    async def get_projects_by_user(self, client_id: int = None, worker_id: int = None) -> List[data_classes.Project]:
-        if client_id:
-            _filter = {'client_id': client_id}
-        elif worker_id:
-            _filter = {'worker_id': worker_id}
-        else:
-            raise ValueError('Must specify one of values.')
+    Если указаны fields, загружаются только эти поля, остальные
+    равны data_classes.NOT_LOADED.
+    """
+
+    async def iter_all_accounts(self, batch_size=100, fields: List[str] = None) -> AsyncIterator[data_classes.Account]:
+        async for a in self.iter_objects(ACCOUNTS, {}, batch_size, projection=_projection(fields)):
+            yield data_classes.Account.from_dict(a, partial=bool(fields))
+
+    async def get_all_accounts(self, fields: List[str] = None) -> List[data_classes.Account]:
+        return [a async for a in self.iter_all_accounts(fields=fields)]
+
+    async def iter_all_projects(self, batch_size=100, fields: List[str] = None) -> AsyncIterator[data_classes.Project]:
+        async for p in self.iter_objects(PROJECTS, {}, batch_size, projection=_projection(fields)):
+            yield data_classes.Project.from_dict(p, partial=bool(fields))
 
-        projects = []
-        for p in await self.get_object(PROJECTS, _filter, many=True):
-            project = data_classes.Project.from_dict(p)
-            projects.append(project)
-        return projects
+    async def get_all_projects(self, fields: List[str] = None) -> List[data_classes.Project]:
+        return [p async for p in self.iter_all_projects(fields=fields)]
 
-    async def get_projects_by_subjects(self, subjects: List[str], only_active=True) -> List[data_classes.Project]:
+    async def get_project_by_id(self, project_id: str, fields: List[str] = None) -> Optional[data_classes.Project]:
+        if fields:
+            _filter = {'_id': ObjectId(project_id)}
+            project_dict = await self.get_object(PROJECTS, _filter, projection=_projection(fields))
+        else:
+            project_dict = await self.get_cached_object(PROJECTS, ObjectId(project_id))
+        return data_classes.Project.from_dict(project_dict, partial=bool(fields))
+
+    @staticmethod
+    def _user_filter(client_id: int = None, worker_id: int = None) -> dict:
+        if client_id:
+            return {'client_id': client_id}
+        elif worker_id:
+            return {'worker_id': worker_id}
+        raise ValueError('Must specify one of values.')
+
+    async def iter_projects_by_user(self, client_id: int = None, worker_id: int = None, batch_size=100,
+                                    fields: List[str] = None) -> AsyncIterator[data_classes.Project]:
+        _filter = self._user_filter(client_id, worker_id)
+        async for p in self.iter_objects(PROJECTS, _filter, batch_size, projection=_projection(fields)):
+            yield data_classes.Project.from_dict(p, partial=bool(fields))
+
+    async def get_projects_by_user(self, client_id: int = None, worker_id: int = None,
+                                   fields: List[str] = None) -> List[data_classes.Project]:
+        return [p async for p in self.iter_projects_by_user(client_id, worker_id, fields=fields)]
+
+    async def get_projects_page_by_user(self, client_id: int = None, worker_id: int = None, after: str = None,
+                                        limit=20, fields: List[str] = None
+                                        ) -> Tuple[List[data_classes.Project], Optional[str]]:
+        """Возвращает страницу проектов (новые первыми) и id для следующей страницы или None."""
+        if limit <= 0:
+            raise ValueError('limit must be positive.')
+        _filter = self._user_filter(client_id, worker_id)
+        after = ObjectId(after) if after else None
+        page = await self.get_page(PROJECTS, _filter, after, limit, projection=_projection(fields))
+        projects = [data_classes.Project.from_dict(p, partial=bool(fields)) for p in page]
+        next_after = projects[-1].id if projects and len(projects) == limit else None
+        return projects, next_after
+
+    async def iter_projects_by_subjects(self, subjects: List[str], only_active=True, batch_size=100,
+                                        fields: List[str] = None) -> AsyncIterator[data_classes.Project]:
         _filter = {'data.subject': {'$in': subjects}}
         if only_active:
             _filter.update(status='Активен')
-        projects = []
-        for p in await self.get_object(PROJECTS, _filter, many=True):
-            project = data_classes.Project.from_dict(p)
-            projects.append(project)
-        return projects
+        async for p in self.iter_objects(PROJECTS, _filter, batch_size, projection=_projection(fields)):
+            yield data_classes.Project.from_dict(p, partial=bool(fields))
+
+    async def get_projects_by_subjects(self, subjects: List[str], only_active=True,
+                                       fields: List[str] = None) -> List[data_classes.Project]:
+        return [p async for p in self.iter_projects_by_subjects(subjects, only_active, fields=fields)]
+
+    async def get_subject_index(self) -> SubjectIndex:
+        """Возвращает индекс предметов, (пере)загружает его из accounts раз в subject_index_ttl секунд."""
+        if self.subject_index.is_expired():
+            if self._subject_index_lock is None:
+                self._subject_index_lock = asyncio.Lock()
+            async with self._subject_index_lock:
+                if self.subject_index.is_expired():
+                    _filter = {'subjects.0': {'$exists': True}}
+                    accounts = self.iter_objects(ACCOUNTS, _filter, 1000, projection={'subjects': 1})
+                    await self.subject_index.load(accounts, self._subject_index_ttl)
+        return self.subject_index
 
-    async def get_account_by_id(self, user_id: int) -> Optional[data_classes.Account]:
-        _filter = {'_id': user_id}
-        account = await self.get_object(ACCOUNTS, _filter)
-        return data_classes.Account.from_dict(account)
+    @staticmethod
+    def _search_filter(text: str = None, status: Optional[str] = 'Активен', subjects: List[str] = None,
+                       min_price: int = None, max_price: int = None,
+                       created_after: datetime = None, created_before: datetime = None) -> dict:
+        _filter = {}
+        if text:
+            _filter['$text'] = {'$search': text}
+        if status:
+            _filter['status'] = status
+        if subjects:
+            _filter['data.subject'] = {'$in': subjects}
+        price = {}
+        if min_price is not None:
+            price['$gte'] = min_price
+        if max_price is not None:
+            price['$lte'] = max_price
+        if price:
+            _filter['data.price'] = price
+        # дата создания проекта хранится в _id
+        created = {}
+        if created_after:
+            created['$gte'] = ObjectId.from_datetime(created_after)
+        if created_before:
+            created['$lt'] = ObjectId.from_datetime(created_before)
+        if created:
+            _filter['_id'] = created
+        return _filter
+
+    async def search_projects(self, text: str = None, status: Optional[str] = 'Активен',
+                              subjects: List[str] = None, min_price: int = None, max_price: int = None,
+                              created_after: datetime = None, created_before: datetime = None,
+                              sort: str = SearchSort.RELEVANCE, after: str = None, limit=20,
+                              fields: List[str] = None) -> Tuple[List[data_classes.Project], Optional[str]]:
+        """Ищет проекты по тексту и фильтрам, возвращает страницу и after для следующей страницы или None.
+
+        Без text или с sort=SearchSort.RECENT сортирует от новых к старым.
+        Загружаются только fields (по умолчанию SEARCH_FIELDS).
+        """
+        if limit <= 0:
+            raise ValueError('limit must be positive.')
+        by_relevance = bool(text) and sort == SearchSort.RELEVANCE
+        pipeline = [{'$match': self._search_filter(text, status, subjects, min_price, max_price,
+                                                   created_after, created_before)}]
+        if by_relevance:
+            pipeline.append({'$addFields': {'score': {'$meta': 'textScore'}}})
+            if after:
+                score, _id = after.split(':')
+                score, _id = float(score), ObjectId(_id)
+                pipeline.append({'$match': {'$or': [{'score': {'$lt': score}}, {'score': score, '_id': {'$lt': _id}}]}})
+            pipeline.append({'$sort': {'score': DESCENDING, '_id': DESCENDING}})
+        else:
+            if after:
+                pipeline.append({'$match': {'_id': {'$lt': ObjectId(after)}}})
+            pipeline.append({'$sort': {'_id': DESCENDING}})
+
+        projection = _projection(fields or SEARCH_FIELDS)
+        if by_relevance:
+            projection['score'] = 1
+        pipeline += [{'$limit': limit}, {'$project': projection}]
+
+        found = await self.aggregate(PROJECTS, pipeline)
+        projects = [data_classes.Project.from_dict(p, partial=True) for p in found]
+        next_after = None
+        if len(found) == limit:
+            last = found[-1]
+            next_after = f'{last["score"]!r}:{last["_id"]}' if by_relevance else str(last['_id'])
+        return projects, next_after
+
+    async def count_project_facets(self, text: str = None, status: Optional[str] = 'Активен',
+                                   subjects: List[str] = None, min_price: int = None, max_price: int = None,
+                                   created_after: datetime = None, created_before: datetime = None) -> dict:
+        """Считает найденные проекты по предметам, типам работ и ценам одним запросом.
+
+        Возвращает {'total': n, 'subject': {...}, 'work_type': {...}, 'price': {нижняя граница: n}},
+        проекты без цены или дороже PRICE_FACETS[-1] считаются в price['other'].
+        """
+        pipeline = [
+            {'$match': self._search_filter(text, status, subjects, min_price, max_price,
+                                           created_after, created_before)},
+            {'$facet': {
+                'total': [{'$count': 'count'}],
+                'subject': [{'$group': {'_id': '$data.subject', 'count': {'$sum': 1}}}, {'$sort': {'count': -1}}],
+                'work_type': [{'$group': {'_id': '$data.work_type', 'count': {'$sum': 1}}}, {'$sort': {'count': -1}}],
+                'price': [{'$bucket': {'groupBy': '$data.price', 'boundaries': PRICE_FACETS, 'default': 'other'}}],
+            }},
+        ]
+        facets = (await self.aggregate(PROJECTS, pipeline))[0]
+        return {
+            'total': facets['total'][0]['count'] if facets['total'] else 0,
+            'subject': {f['_id']: f['count'] for f in facets['subject']},
+            'work_type': {f['_id']: f['count'] for f in facets['work_type']},
+            'price': {f['_id']: f['count'] for f in facets['price']},
+        }
+
+    async def get_account_ids_by_subject(self, subject: str) -> Set[int]:
+        """Возвращает id аккаунтов с предметом subject (из индекса в памяти)."""
+        index = await self.get_subject_index()
+        return index.get(subject)
+
+    async def iter_accounts_by_subject(self, subject: str, batch_size=100,
+                                       fields: List[str] = None) -> AsyncIterator[data_classes.Account]:
+        """Итерирует аккаунты с предметом subject (по индексу accounts.subjects)."""
+        async for a in self.iter_objects(ACCOUNTS, {'subjects': subject}, batch_size, projection=_projection(fields)):
+            yield data_classes.Account.from_dict(a, partial=bool(fields))
+
+    async def get_account_by_id(self, user_id: int, fields: List[str] = None) -> Optional[data_classes.Account]:
+        if fields:
+            account = await self.get_object(ACCOUNTS, {'_id': user_id}, projection=_projection(fields))
+        else:
+            account = await self.get_cached_object(ACCOUNTS, user_id)
+        return data_classes.Account.from_dict(account, partial=bool(fields))
 
-    async def get_chat_by_id(self, chat_id: int) -> Optional[data_classes.Chat]:
+    async def get_chat_by_id(self, chat_id: int, fields: List[str] = None) -> Optional[data_classes.Chat]:
         _filter = {'_id': chat_id}
-        chat = await self.get_object(CHATS, _filter)
-        return data_classes.Chat.from_dict(chat)
-
-    async def get_bid_by_id(self, bid_id: str) -> Optional[data_classes.Bid]:
+        chat = await self.get_object(CHATS, _filter, projection=_projection(fields))
+        return data_classes.Chat.from_dict(chat, partial=bool(fields))
+
+    async def get_pair_chat_id(self, chat_id: int) -> Optional[int]:
+        """Возвращает id связанной группы или None, результат кэшируется (в т.ч. отсутствие)."""
+        pair_id = self.chats_cache.get(chat_id)
+        if pair_id is MISSING:
+            chat = await self.get_object(CHATS, {'_id': chat_id}, projection={'_id': 0, 'pair_id': 1})
+            pair_id = chat.get('pair_id') if chat else None
+            self.chats_cache.set(chat_id, pair_id)
+        return pair_id
+
+    async def get_pair_message_id(self, chat_id: int, message_id: int) -> Optional[int]:
+        """Возвращает id копии сообщения в связанной группе или None."""
+        pair_message_id = self.messages_cache.get((chat_id, message_id))
+        if pair_message_id is MISSING:
+            _filter = {'_id': f'{chat_id}:{message_id}'}
+            message = await self.get_object(MESSAGES, _filter, projection={'_id': 0, 'pair_message_id': 1})
+            if not message:
+                return None
+            pair_message_id = message['pair_message_id']
+            self.messages_cache.set((chat_id, message_id), pair_message_id)
+        return pair_message_id
+
+    async def get_worker_rating(self, worker_id: int) -> Optional[data_classes.WorkerRating]:
+        rating = await self.get_object(RATINGS, {'_id': worker_id})
+        return data_classes.WorkerRating.from_dict(rating)
+
+    async def get_top_workers(self, limit=10, fields: List[str] = None) -> List[data_classes.WorkerRating]:
+        """Возвращает рейтинги исполнителей с наибольшей средней оценкой."""
+        cursor = self.iter_objects(RATINGS, {}, limit, [('score', DESCENDING)], limit, _projection(fields))
+        return [data_classes.WorkerRating.from_dict(r, partial=bool(fields)) async for r in cursor]
+
+    async def get_bid_by_id(self, bid_id: str, fields: List[str] = None) -> Optional[data_classes.Bid]:
         _filter = {'_id': ObjectId(bid_id)}
-        bid = await self.get_object(BIDS, _filter)
-        return data_classes.Bid.from_dict(bid)
+        bid = await self.get_object(BIDS, _filter, projection=_projection(fields))
+        return data_classes.Bid.from_dict(bid, partial=bool(fields))
+
+    async def iter_reviews_by_worker(self, worker_id: int, batch_size=100,
+                                     fields: List[str] = None) -> AsyncIterator[data_classes.Review]:
+        _filter = {'worker_id': worker_id}
+        async for r in self.iter_objects(REVIEWS, _filter, batch_size, projection=_projection(fields)):
+            yield data_classes.Review.from_dict(r, partial=bool(fields))
 
-    async def get_reviews_by_worker(self, worker_id: int) -> List[data_classes.Review]:
-        reviews = []
-        for r in await self.get_object(REVIEWS, {'worker_id': worker_id}, many=True):
-            reviews.append(data_classes.Review.from_dict(r))
-        return reviews
+    async def get_reviews_by_worker(self, worker_id: int, fields: List[str] = None) -> List[data_classes.Review]:
+        return [r async for r in self.iter_reviews_by_worker(worker_id, fields=fields)]
 
 
 class MongoDeleter(MongoBase):
@@ -192,6 +962,7 @@ class MongoDeleter(MongoBase):
     async def delete_account_by_id(self, user_id: int):
         _filter = {'_id': user_id}
         await self.delete_object(ACCOUNTS, _filter)
+        self.subject_index.remove(user_id)
 
     async def delete_bid_by_id(self, bid_id: str):
         _filter = {'_id': ObjectId(bid_id)}
@@ -205,16 +976,14 @@ class MongoDeleter(MongoBase):
 class MongoUpdater(MongoBase):
     """Содержит методы для обновления объектов в коллекциях."""
 
-    async def incr_balance(self, user_id: int, amount: int):
-        await self.update_object(ACCOUNTS, {'_id': user_id}, '$inc', {'balance': amount})
-
     async def update_account_subjects(self, user_id: int, subjects: List[str]):
         _filter = {'_id': user_id}
         await self.update_object(ACCOUNTS, _filter, '$set', {'subjects': subjects})
+        self.subject_index.set(user_id, subjects)
 
     async def update_account_profile(self, user_id: int, profile: data_classes.Profile):
         _filter = {'_id': user_id}
-        await self.update_object(ACCOUNTS, _filter, '$set', {'profile': asdict(profile)})
+        await self.update_object(ACCOUNTS, _filter, '$set', {'profile': profile.to_dict()})
 
     async def update_account_page_url(self, user_id: int, page_url: str):
         _filter = {'_id': user_id}
@@ -225,8 +994,12 @@ class MongoUpdater(MongoBase):
         await self.update_object(ACCOUNTS, _filter, '$set', {f'profile.{profile_field}': new_value})
 
     async def update_project(self, project_id: str, field: str, new_value):
+        await self.update_project_fields(project_id, {field: new_value})
+
+    async def update_project_fields(self, project_id: str, fields: dict):
+        """Обновляет несколько полей проекта одним запросом."""
         _filter = {'_id': ObjectId(project_id)}
-        await self.update_object(PROJECTS, _filter, '$set', {field: new_value}, upsert=False)
+        await self.update_object(PROJECTS, _filter, '$set', fields, upsert=False)
 
     async def update_project_data(self, project_id: str, data_field: str, new_value):
         await self.update_project(project_id, f'data.{data_field}', new_value)
@@ -245,8 +1018,8 @@ class MongoProjectUpdater(MongoUpdater):
         await self.update_project(project_id, 'worker_id', worker_id)
 
     async def update_project_chats(self, project_id: str, client_chat_id: int, worker_chat_id: int):
-        await self.update_project(project_id, 'client_chat_id', client_chat_id)
-        await self.update_project(project_id, 'worker_chat_id', worker_chat_id)
+        await self.update_project_fields(project_id, {'client_chat_id': client_chat_id,
+                                                      'worker_chat_id': worker_chat_id})
 
     async def update_project_price(self, project_id: str, price: int):
         await self.update_project_data(project_id, 'price', price)
@@ -271,6 +1044,118 @@ class MongoProfileUpdater(MongoUpdater):
         await self.update_profile(user_id, 'works', works)
 
 
+class MongoLedger(MongoBase):
+    """Содержит методы журнала балансов.
+
+    Изменения баланса только добавляются в коллекцию ledger, accounts.balance - снимок:
+    баланс до появления журнала и сумма записей до accounts.balance_until.
+    compact_balances переносит старые записи в снимки, записи не удаляются и не изменяются.
+    """
+
+    async def get_db(self) -> AsyncIOMotorDatabase:
+        db = await super().get_db()
+        if self._compaction_interval and self._compactor is None:
+            self._compactor = asyncio.create_task(self._compact_periodically())
+        return db
+
+    async def close(self):
+        if self._compactor:
+            self._compactor.cancel()
+            self._compactor = None
+        await super().close()
+
+    async def incr_balance(self, user_id: int, amount: int, key: str = None, reason: str = None) -> bool:
+        """Добавляет запись в журнал, возвращает False, если запись с ключом key уже есть."""
+        entry = data_classes.LedgerEntry(user_id, amount, reason, _id=key)
+        return await self.add_ledger_entries([entry]) == 1
+
+    async def add_ledger_entries(self, entries: List[data_classes.LedgerEntry]) -> int:
+        """Добавляет записи одним запросом, повторы по _id пропускаются, возвращает число добавленных.
+
+        Дата записи всегда текущая: более ранние могли уже попасть в снимок.
+        """
+        date = datetime.utcnow()
+        documents = []
+        for entry in entries:
+            document = entry.to_dict()
+            if document['_id'] is None:
+                del document['_id']
+            document['date'] = date
+            documents.append(document)
+        return await self.insert_objects(LEDGER, documents)
+
+    async def _ledger_sum(self, account_id: int, since: datetime = None, until: datetime = None) -> int:
+        pipeline = [
+            {'$match': {'account_id': account_id, **_date_range(since, until)}},
+            {'$group': {'_id': None, 'amount': {'$sum': '$amount'}}},
+        ]
+        result = await self.aggregate(LEDGER, pipeline)
+        return result[0]['amount'] if result else 0
+
+    async def get_balance(self, user_id: int) -> int:
+        """Возвращает баланс: снимок из accounts и записи журнала после него."""
+        # устаревший снимок из кэша тоже даёт верную сумму, так как записи не удаляются
+        account = await self.get_cached_object(ACCOUNTS, user_id) or {}
+        return account.get('balance', 0) + await self._ledger_sum(user_id, account.get('balance_until'))
+
+    async def get_ledger_entries(self, user_id: int, limit=20) -> List[data_classes.LedgerEntry]:
+        """Возвращает последние записи журнала аккаунта."""
+        entries = self.iter_objects(LEDGER, {'account_id': user_id}, limit, [('date', DESCENDING)], limit)
+        return [data_classes.LedgerEntry.from_dict(e) async for e in entries]
+
+    async def compact_balances(self, grace: float = LEDGER_GRACE) -> int:
+        """Переносит записи старше grace секунд в снимки балансов, возвращает число обновлённых аккаунтов.
+
+        Можно запускать в нескольких процессах: снимок обновляется, только если
+        не изменился с момента чтения.
+        """
+        db = await self.get_db()
+        cutoff = datetime.utcnow() - timedelta(seconds=grace)
+        # MongoDB хранит даты с точностью до миллисекунд
+        cutoff = cutoff.replace(microsecond=cutoff.microsecond // 1000 * 1000)
+
+        state = await db[LEDGER_STATE].find_one({'_id': 'compaction'})
+        since = state['until'] if state else None
+        pipeline = [
+            {'$match': _date_range(since, cutoff)},
+            {'$group': {'_id': '$account_id', 'amount': {'$sum': '$amount'}}},
+        ]
+        amounts = {group['_id']: group['amount'] for group in await self.aggregate(LEDGER, pipeline)}
+        accounts = {a['_id']: a.get('balance_until') async for a in
+                    db[ACCOUNTS].find({'_id': {'$in': list(amounts)}}, {'balance_until': 1})}
+
+        requests, compacted = [], []
+        for account_id, amount in amounts.items():
+            until = accounts.get(account_id)
+            if until is not None and until >= cutoff:
+                continue
+            if until != since:
+                # снимок отстал или прошлая компактизация прервалась
+                amount = await self._ledger_sum(account_id, until, cutoff)
+            compacted.append(account_id)
+            requests.append(UpdateOne({'_id': account_id, 'balance_until': until},
+                                      {'$inc': {'balance': amount}, '$set': {'balance_until': cutoff}},
+                                      upsert=account_id not in accounts))
+        if requests:
+            try:
+                await db[ACCOUNTS].bulk_write(requests, ordered=False)
+            except BulkWriteError as e:
+                # аккаунт одновременно создан другим процессом
+                _check_duplicates(e)
+            await self._invalidate([(ACCOUNTS, {'_id': account_id}) for account_id in compacted])
+
+        await db[LEDGER_STATE].update_one({'_id': 'compaction'}, {'$max': {'until': cutoff}}, upsert=True)
+        return len(requests)
+
+    async def _compact_periodically(self):
+        while True:
+            await asyncio.sleep(self._compaction_interval)
+            try:
+                await self.compact_balances()
+            except Exception:
+                log.exception('Cause exception while compacting balances.')
+
+
 class MongoDB(MongoAdder, MongoGetter, MongoDeleter,
-              MongoProjectUpdater, MongoProfileUpdater):
+              MongoProjectUpdater, MongoProfileUpdater, MongoLedger):
     """Наследует все наборы методов управления базой."""
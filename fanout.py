@@ -0,0 +1,50 @@
+"""Notify workers subscribed to a project subject.
+
+Recipients come from the in-memory subject index (`users_db.get_subject_index`),
+so the cost is proportional to the matching workers, not to all accounts.
+Messages go through `sender`, which keeps them within Telegram rate limits.
+"""
+import asyncio
+import logging
+from typing import Iterable, Optional, Tuple
+
+from aiogram import types
+
+import data_classes
+from loader import bot, sender, users_db
+
+log = logging.getLogger(__name__)
+
+
+async def send_in_chunks(user_ids: Iterable[int], text: str, reply_markup: Optional[types.InlineKeyboardMarkup] = None,
+                         chunk_size: int = 100) -> Tuple[int, int]:
+    """Send `text` to users, scheduling at most `chunk_size` messages at once.
+
+    Return amount of sent and failed messages (e.g. bot was blocked).
+    """
+    sent = failed = 0
+    user_ids = list(user_ids)
+    for i in range(0, len(user_ids), chunk_size):
+        chunk = user_ids[i:i + chunk_size]
+        results = await asyncio.gather(
+            *[sender.call(user_id, bot.send_message, user_id, text, reply_markup=reply_markup) for user_id in chunk],
+            return_exceptions=True,
+        )
+        for user_id, result in zip(chunk, results):
+            if isinstance(result, Exception):
+                failed += 1
+                log.debug('Cannot notify %s: %r', user_id, result)
+            else:
+                sent += 1
+    return sent, failed
+
+
+async def notify_workers(project: data_classes.Project, text: str,
+                         reply_markup: Optional[types.InlineKeyboardMarkup] = None,
+                         chunk_size: int = 100) -> Tuple[int, int]:
+    """Send `text` about a new project to workers with its subject (except its client)."""
+    worker_ids = await users_db.get_account_ids_by_subject(project.data.subject)
+    worker_ids.discard(project.client_id)
+    sent, failed = await send_in_chunks(sorted(worker_ids), text, reply_markup, chunk_size)
+    log.info('Project %s: notified %s workers, %s failed', project.id, sent, failed)
+    return sent, failed
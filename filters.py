@@ -21,10 +21,13 @@ class QueryPrefix:
 
 
 async def find_pair_chat(*_) -> Union[dict, bool]:
-    """Try to find a pair chat (group) and return it id ('pchat_id')."""
+    """Try to find a pair chat (group) and return it id ('pchat_id').
+
+    Lookups are cached in `users_db.chats_cache`, see its `stats()` for hits/misses.
+    """
     chat = types.Chat.get_current()
     if chat.type == 'group':
-        chat_obj = await users_db.get_chat_by_id(chat.id)
-        if chat_obj:
-            return {'pchat_id': chat_obj.pair_id}
+        pair_id = await users_db.get_pair_chat_id(chat.id)
+        if pair_id:
+            return {'pchat_id': pair_id}
     return False
@@ -0,0 +1,189 @@
+"""FSM storage which keeps states in memory and writes them to Mongo in background."""
+import asyncio
+import copy
+import logging
+from collections import OrderedDict
+from typing import Dict, Optional, Tuple
+
+from aiogram.contrib.fsm_storage.mongo import BUCKET, DATA, STATE, MongoStorage
+from aiogram.dispatcher.storage import BaseStorage
+from pymongo import DeleteOne, UpdateOne
+
+from cache import MISSING
+
+log = logging.getLogger(__name__)
+
+FIELDS = {STATE: 'state', DATA: 'data', BUCKET: 'bucket'}
+
+Key = Tuple[str, str]
+
+
+class TieredStorage(BaseStorage):
+    """In-memory LRU of states, data and buckets over `MongoStorage`.
+
+    Reads are served from memory, misses are loaded from Mongo (absence is
+    cached too). Writes go to memory and are flushed to Mongo with one
+    bulk_write per collection every `flush_interval` seconds, or earlier
+    when `max_dirty` writes are pending. `close` flushes everything.
+    """
+
+    def __init__(self, backend: MongoStorage = None, maxsize: int = 10_000,
+                 flush_interval: float = 1.0, max_dirty: int = 1000):
+        self.backend = backend or MongoStorage()
+        self.maxsize = maxsize
+        self.flush_interval = flush_interval
+        self.max_dirty = max_dirty
+
+        self._entries: Dict[Key, dict] = OrderedDict()
+        self._dirty: Dict[Tuple[Key, str], object] = {}
+        self._flushing: Dict[Tuple[Key, str], object] = {}
+        self._flusher: Optional[asyncio.Task] = None
+        self._flush_now: Optional[asyncio.Event] = None
+        self._flush_lock: Optional[asyncio.Lock] = None
+        self._closing = False
+
+    async def _get(self, chat, user, collection: str):
+        key = self.check_address(chat=chat, user=user)
+        entry = self._entries.get(key)
+        if entry is not None:
+            self._entries.move_to_end(key)
+            value = entry.get(collection, MISSING)
+            if value is not MISSING:
+                return value
+
+        value = self._dirty.get((key, collection), MISSING)
+        if value is MISSING:
+            value = self._flushing.get((key, collection), MISSING)
+        if value is MISSING:
+            db = await self.backend.get_db()
+            document = await db[collection].find_one({'chat': key[0], 'user': key[1]})
+            value = document.get(FIELDS[collection]) if document else None
+            entry = self._entries.get(key)
+            if entry is not None and collection in entry:
+                # set while loading
+                return entry[collection]
+        self._put(key, collection, value)
+        return value
+
+    def _put(self, key: Key, collection: str, value):
+        entry = self._entries.get(key)
+        if entry is None:
+            entry = self._entries[key] = {}
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+        else:
+            self._entries.move_to_end(key)
+        entry[collection] = value
+
+    def _set(self, chat, user, collection: str, value):
+        key = self.check_address(chat=chat, user=user)
+        self._put(key, collection, value)
+        self._dirty[(key, collection)] = value
+
+        if self._flusher is None:
+            self._flush_now = asyncio.Event()
+            self._flush_lock = asyncio.Lock()
+            self._flusher = asyncio.create_task(self._flush_periodically())
+        if len(self._dirty) >= self.max_dirty:
+            self._flush_now.set()
+
+    async def _flush_periodically(self):
+        while not self._closing:
+            try:
+                await asyncio.wait_for(self._flush_now.wait(), self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._flush_now.clear()
+            try:
+                await self.flush()
+            except Exception:
+                log.exception('Cause exception while flushing FSM storage, retry later.')
+
+    async def flush(self):
+        """Write pending changes to Mongo."""
+        if not self._dirty or self._flush_lock is None:
+            return
+        async with self._flush_lock:
+            self._flushing, self._dirty = self._dirty, {}
+            requests: Dict[str, list] = {}
+            for (key, collection), value in self._flushing.items():
+                _filter = {'chat': key[0], 'user': key[1]}
+                if collection == STATE and value is None:
+                    request = DeleteOne(_filter)
+                else:
+                    request = UpdateOne(_filter, {'$set': {FIELDS[collection]: value}}, upsert=True)
+                requests.setdefault(collection, []).append(request)
+            try:
+                db = await self.backend.get_db()
+                for collection, collection_requests in requests.items():
+                    await db[collection].bulk_write(collection_requests, ordered=False)
+            except BaseException:
+                # also on cancellation: keep the batch, newer writes made during the flush win
+                self._dirty = {**self._flushing, **self._dirty}
+                raise
+            finally:
+                self._flushing = {}
+
+    async def close(self, attempts: int = 3):
+        if self._flusher:
+            # let a running flush complete instead of cancelling it
+            self._closing = True
+            self._flush_now.set()
+            await self._flusher
+            self._flusher = None
+        for attempt in range(1, attempts + 1):
+            try:
+                await self.flush()
+                break
+            except Exception:
+                log.exception('Cannot flush FSM storage (attempt %s of %s).', attempt, attempts)
+                await asyncio.sleep(attempt)
+        else:
+            log.error('%s FSM storage changes are lost.', len(self._dirty))
+        await self.backend.close()
+
+    async def wait_closed(self):
+        return await self.backend.wait_closed()
+
+    async def get_state(self, *, chat=None, user=None, default: Optional[str] = None) -> Optional[str]:
+        state = await self._get(chat, user, STATE)
+        return default if state is None else state
+
+    async def set_state(self, *, chat=None, user=None, state: Optional[str] = None):
+        self._set(chat, user, STATE, state)
+
+    async def get_data(self, *, chat=None, user=None, default: Optional[dict] = None) -> dict:
+        data = await self._get(chat, user, DATA)
+        return copy.deepcopy(data) if data is not None else default or {}
+
+    async def set_data(self, *, chat=None, user=None, data: dict = None):
+        self._set(chat, user, DATA, copy.deepcopy(data or {}))
+
+    async def update_data(self, *, chat=None, user=None, data: dict = None, **kwargs):
+        temp_data = await self.get_data(chat=chat, user=user, default={})
+        temp_data.update(data or {}, **kwargs)
+        await self.set_data(chat=chat, user=user, data=temp_data)
+
+    def has_bucket(self):
+        return True
+
+    async def get_bucket(self, *, chat=None, user=None, default: Optional[dict] = None) -> dict:
+        bucket = await self._get(chat, user, BUCKET)
+        return copy.deepcopy(bucket) if bucket is not None else default or {}
+
+    async def set_bucket(self, *, chat=None, user=None, bucket: dict = None):
+        self._set(chat, user, BUCKET, copy.deepcopy(bucket or {}))
+
+    async def update_bucket(self, *, chat=None, user=None, bucket: dict = None, **kwargs):
+        temp_bucket = await self.get_bucket(chat=chat, user=user)
+        temp_bucket.update(bucket or {}, **kwargs)
+        await self.set_bucket(chat=chat, user=user, bucket=temp_bucket)
+
+    async def reset_all(self, full=True):
+        await self.flush()
+        self._entries.clear()
+        await self.backend.reset_all(full)
+
+    async def get_states_list(self):
+        await self.flush()
+        return await self.backend.get_states_list()
@@ -1,13 +1,98 @@
-import re
+import asyncio
+from typing import List, Optional
 
 from aiogram import types
 from aiogram.dispatcher.filters import IDFilter
+from aiogram.utils.exceptions import BadRequest, MessageNotModified
 
 import texts
+from albums import MediaGroupBuffer
 from config import GROUP_ADMIN_ID
 from filters import find_pair_chat
-from loader import dp
-from texts.misc import STOP_WORDS
+from loader import dp, sender, users_db
+from moderation import Verdict, moderator
+from sender import Priority
+
+ERROR_TEXTS = {
+    Verdict.STOP_WORD: texts.error_stop_word,
+    Verdict.USERNAME: texts.error_username,
+    Verdict.PHONE: texts.error_phone,
+}
+
+INPUT_MEDIA = {
+    types.ContentType.PHOTO: types.InputMediaPhoto,
+    types.ContentType.VIDEO: types.InputMediaVideo,
+    types.ContentType.ANIMATION: types.InputMediaAnimation,
+    types.ContentType.AUDIO: types.InputMediaAudio,
+    types.ContentType.DOCUMENT: types.InputMediaDocument,
+}
+
+
+async def is_forbidden(msg: types.Message) -> bool:
+    """Check message text or caption, answer with error if it is forbidden."""
+    verdict = moderator.check(msg.text or msg.caption, msg.from_user.username)
+    if verdict:
+        await sender.call(msg.chat.id, msg.answer, ERROR_TEXTS[verdict])
+        return True
+    return False
+
+
+def input_media(msg: types.Message) -> Optional[types.InputMedia]:
+    """Build InputMedia with the same file and caption, None if type is not supported."""
+    media_cls = INPUT_MEDIA.get(msg.content_type)
+    if media_cls is None:
+        return None
+    media = getattr(msg, msg.content_type)
+    if msg.content_type == types.ContentType.PHOTO:
+        media = media[-1]
+    caption = msg.html_text if msg.caption else None
+    return media_cls(media.file_id, caption=caption)
+
+
+async def copy_to_pair(msg: types.Message, pchat_id: int, **kwargs) -> int:
+    """Copy message to the pair chat and remember its counterpart."""
+    new_msg = await sender.call(pchat_id, msg.copy_to, pchat_id, **kwargs)
+    await users_db.add_message_pair(msg.chat.id, msg.message_id, pchat_id, new_msg.message_id)
+    return new_msg.message_id
+
+
+async def edit_pair_message(msg: types.Message, pchat_id: int, pair_msg_id: int) -> bool:
+    """Apply edit to the counterpart in place, return False if it is impossible."""
+    try:
+        if msg.text:
+            await sender.call(pchat_id, dp.bot.edit_message_text, msg.html_text, pchat_id, pair_msg_id)
+            return True
+        media = input_media(msg)
+        if media:
+            await sender.call(pchat_id, dp.bot.edit_message_media, media, pchat_id, pair_msg_id)
+            return True
+        if msg.caption:
+            await sender.call(pchat_id, dp.bot.edit_message_caption, pchat_id, pair_msg_id, caption=msg.html_text)
+            return True
+    except MessageNotModified:
+        return True
+    except BadRequest:
+        pass
+    return False
+
+
+async def send_album(messages: List[types.Message], pchat_id: int):
+    """Send album to the pair chat with one call, copy messages one by one if it is impossible."""
+    media = [input_media(msg) for msg in messages]
+    if all(media):
+        try:
+            sent = await sender.call(pchat_id, dp.bot.send_media_group, pchat_id, media)
+        except BadRequest:
+            pass
+        else:
+            await asyncio.gather(*[users_db.add_message_pair(msg.chat.id, msg.message_id, pchat_id, new_msg.message_id)
+                                   for msg, new_msg in zip(messages, sent)])
+            return
+    for msg in messages:
+        await copy_to_pair(msg, pchat_id)
+
+
+album_buffer = MediaGroupBuffer(send_album)
 
 
 @dp.message_handler(text_startswith='/')
@@ -18,49 +103,64 @@ async def ignore_msg(*_):
 
 @dp.message_handler(find_pair_chat, content_types='any', user_id=GROUP_ADMIN_ID)
 async def forward_from_admin(msg: types.Message, pchat_id: int):
-    await msg.forward(pchat_id)
+    await album_buffer.flush_chat(msg.chat.id)
+    new_msg = await sender.call(pchat_id, msg.forward, pchat_id, priority=Priority.HIGH)
+    await users_db.add_message_pair(msg.chat.id, msg.message_id, pchat_id, new_msg.message_id)
 
 
 @dp.message_handler(find_pair_chat, ~IDFilter(dp.bot.id), content_types=types.ContentType.PINNED_MESSAGE)
 async def forward_pinned(msg: types.Message, pchat_id: int):
-    await dp.bot.send_message(pchat_id, '<b>Ваш собеседник закрепил сообщение:</b>')
-    new_msg = await msg.pinned_message.copy_to(pchat_id)
-    await dp.bot.pin_chat_message(pchat_id, new_msg.message_id)
+    await album_buffer.flush_chat(msg.chat.id)
+    pinned = msg.pinned_message
+    pair_msg_id = await users_db.get_pair_message_id(msg.chat.id, pinned.message_id)
+    if not pair_msg_id:
+        await sender.call(pchat_id, dp.bot.send_message, pchat_id, '<b>Ваш собеседник закрепил сообщение:</b>')
+        pair_msg_id = await copy_to_pair(pinned, pchat_id)
+    await sender.call(pchat_id, dp.bot.pin_chat_message, pchat_id, pair_msg_id)
 
 
 @dp.edited_message_handler(find_pair_chat)
 async def forward_edited(msg: types.Message, pchat_id: int):
-    await dp.bot.send_message(pchat_id, '<b>Ваш собеседник изменил сообщение на:</b>')
-    await msg.copy_to(pchat_id)
+    await album_buffer.flush_chat(msg.chat.id)
+    if await is_forbidden(msg):
+        return
+    pair_msg_id = await users_db.get_pair_message_id(msg.chat.id, msg.message_id)
+    if pair_msg_id and await edit_pair_message(msg, pchat_id, pair_msg_id):
+        return
+    await sender.call(pchat_id, dp.bot.send_message, pchat_id, '<b>Ваш собеседник изменил сообщение на:</b>')
+    await copy_to_pair(msg, pchat_id)
 
 
 @dp.message_handler(find_pair_chat, is_reply=True)
 async def forward_reply(msg: types.Message, reply: types.Message, pchat_id: int):
-    await dp.bot.send_message(pchat_id, '<b>Ваш собеседник ответил на сообщение ниже:</b>')
-    new_reply = await reply.copy_to(pchat_id)
-    await msg.copy_to(pchat_id, reply_to_message_id=new_reply.message_id)
+    await album_buffer.flush_chat(msg.chat.id)
+    if await is_forbidden(msg):
+        return
+    pair_reply_id = await users_db.get_pair_message_id(msg.chat.id, reply.message_id)
+    if not pair_reply_id:
+        await sender.call(pchat_id, dp.bot.send_message, pchat_id, '<b>Ваш собеседник ответил на сообщение ниже:</b>')
+        pair_reply_id = await copy_to_pair(reply, pchat_id)
+    await copy_to_pair(msg, pchat_id, reply_to_message_id=pair_reply_id, allow_sending_without_reply=True)
 
 
 @dp.message_handler(find_pair_chat)
 async def forward_text(msg: types.Message, pchat_id: int):
     """Копирует все текстовые сообщения в связанную группу."""
-    username = msg.from_user.username
-    lower_msg_text = msg.text.lower()
-
-    for word in STOP_WORDS:
-        if word.lower() in lower_msg_text:
-            await msg.answer(texts.error_stop_word)
-            return
-
-    if username and username.lower() in lower_msg_text:
-        await msg.answer(texts.error_username)
-    elif re.search(r'(380)?[0-9-–() ]{9,}', lower_msg_text):
-        await msg.answer(texts.error_phone)
-    else:
-        await msg.copy_to(pchat_id)
+    await album_buffer.flush_chat(msg.chat.id)
+    if not await is_forbidden(msg):
+        await copy_to_pair(msg, pchat_id)
 
 
 @dp.message_handler(find_pair_chat, content_types='any')
 async def forward_any(msg: types.Message, pchat_id: int):
-    """Копирует любые сообщения в связанную группу."""
-    await msg.copy_to(pchat_id)
+    """Копирует любые сообщения в связанную группу (подписи проверяются).
+
+    Сообщения альбома собираются и отправляются одним send_media_group.
+    """
+    if msg.media_group_id:
+        if not await is_forbidden(msg):
+            album_buffer.add(msg, pchat_id)
+        return
+    await album_buffer.flush_chat(msg.chat.id)
+    if not await is_forbidden(msg):
+        await copy_to_pair(msg, pchat_id)
@@ -1,10 +1,32 @@
-from aiogram import Bot, Dispatcher
+import os
+
+from aiogram import Bot
+from aiogram.bot.api import TELEGRAM_PRODUCTION, TelegramAPIServer
 from aiogram.contrib.fsm_storage.mongo import MongoStorage
 
 from config import BOT_TOKEN
 from database_api import MongoDB
+from fsm_storage import TieredStorage
+from metrics import InstrumentedBot, MongoListener
+from sender import SendScheduler
+from stats import Statistics
+from updates import OrderedDispatcher
+
+# e.g. local Bot API server or a fake one for tests
+BOT_API_SERVER = os.getenv('BOT_API_SERVER')
+# serve metrics on this port (see metrics.py), disabled if not set
+METRICS_PORT = os.getenv('METRICS_PORT')
+# number of processes sending messages (webhook workers), they share the flood limits
+SENDER_PROCESSES = int(os.getenv('SENDER_PROCESSES', 1))
 
-bot = Bot(BOT_TOKEN, parse_mode='html')
-storage = MongoStorage()
-dp = Dispatcher(bot, storage=storage)
-users_db = MongoDB()
+server = TelegramAPIServer.from_base(BOT_API_SERVER) if BOT_API_SERVER else TELEGRAM_PRODUCTION
+bot = (InstrumentedBot if METRICS_PORT else Bot)(BOT_TOKEN, parse_mode='html', server=server)
+sender = SendScheduler(processes=SENDER_PROCESSES)
+storage = TieredStorage(MongoStorage())
+dp = OrderedDispatcher(bot, storage=storage, concurrency=32, max_pending=1000)
+# fold the balance ledger into account snapshots every minute, get_balance reads only newer entries
+db_options = {'ledger_compaction_interval': 60}
+if METRICS_PORT:
+    db_options['event_listeners'] = [MongoListener()]
+users_db = MongoDB(**db_options)
+statistics = Statistics(users_db)
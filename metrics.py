@@ -0,0 +1,285 @@
+"""Latency histograms and counters exposed in Prometheus text format.
+
+Disabled unless `METRICS_PORT` is set (see loader.py), then it times:
+handlers and their filters (`MetricsMiddleware`), Mongo commands
+(`MongoListener`) and Bot API requests (`InstrumentedBot`).
+Metrics may be updated from other threads (motor runs pymongo, and so
+command listeners, in executor threads), so every metric has a lock.
+"""
+import abc
+import bisect
+import logging
+import threading
+import time
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+from aiogram import Bot, Dispatcher
+from aiogram.dispatcher.handler import current_handler
+from aiogram.dispatcher.middlewares import BaseMiddleware
+from aiogram.utils.exceptions import RetryAfter, TelegramAPIError
+from aiohttp import web
+from pymongo import monitoring
+
+log = logging.getLogger(__name__)
+
+# seconds, from 0.5 ms to 10 s
+DEFAULT_BUCKETS = (.0005, .001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10)
+
+
+def _format_labels(names: Tuple[str, ...], values: Tuple[str, ...], extra: str = '') -> str:
+    pairs = [f'{n}="{v}"' for n, v in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+class _HistogramChild:
+    __slots__ = ('_buckets', '_counts', 'sum', '_lock')
+
+    def __init__(self, buckets: Tuple[float, ...], lock: threading.Lock):
+        self._buckets = buckets
+        self._counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self._lock = lock
+
+    def observe(self, value: float):
+        index = bisect.bisect_left(self._buckets, value)
+        with self._lock:
+            self._counts[index] += 1
+            self.sum += value
+
+    @property
+    def count(self) -> int:
+        return sum(self._counts)
+
+    def cumulative(self) -> Iterable[Tuple[str, int]]:
+        total = 0
+        for bound, count in zip(self._buckets, self._counts):
+            total += count
+            yield repr(float(bound)), total
+        yield '+Inf', total + self._counts[-1]
+
+
+class _CounterChild:
+    __slots__ = ('value', '_lock')
+
+    def __init__(self, lock: threading.Lock):
+        self.value = 0
+        self._lock = lock
+
+    def inc(self, amount: float = 1):
+        with self._lock:
+            self.value += amount
+
+
+class _Metric(abc.ABC):
+    type = ''
+
+    def __init__(self, name: str, documentation: str, labelnames: Iterable[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._children: Dict[tuple, object] = {}
+        # shared with children, updates are short
+        self._lock = threading.Lock()
+
+    @abc.abstractmethod
+    def _new_child(self):
+        """Return a new child for a combination of label values."""
+
+    def labels(self, *values):
+        child = self._children.get(values)
+        if child is None:
+            with self._lock:
+                child = self._children.get(values)
+                if child is None:
+                    child = self._children[values] = self._new_child()
+        return child
+
+    def render(self) -> List[str]:
+        return [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.type}']
+
+
+class Histogram(_Metric):
+    type = 'histogram'
+
+    def __init__(self, name: str, documentation: str, labelnames: Iterable[str] = (),
+                 buckets: Tuple[float, ...] = DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def _new_child(self) -> _HistogramChild:
+        return _HistogramChild(self.buckets, self._lock)
+
+    @property
+    def count(self) -> int:
+        """Observations of all label values."""
+        with self._lock:
+            return sum(child.count for child in self._children.values())
+
+    def render(self) -> List[str]:
+        lines = super().render()
+        with self._lock:
+            for values, child in self._children.items():
+                for bound, count in child.cumulative():
+                    labels = _format_labels(self.labelnames, values, f'le="{bound}"')
+                    lines.append(f'{self.name}_bucket{labels} {count}')
+                labels = _format_labels(self.labelnames, values)
+                lines.append(f'{self.name}_sum{labels} {child.sum}')
+                lines.append(f'{self.name}_count{labels} {child.count}')
+        return lines
+
+
+class Counter(_Metric):
+    type = 'counter'
+
+    def _new_child(self) -> _CounterChild:
+        return _CounterChild(self._lock)
+
+    def render(self) -> List[str]:
+        lines = super().render()
+        with self._lock:
+            for values, child in self._children.items():
+                lines.append(f'{self.name}{_format_labels(self.labelnames, values)} {child.value}')
+        return lines
+
+
+class Registry:
+    """Metrics and gauge collectors rendered together."""
+
+    def __init__(self):
+        self._metrics: List[_Metric] = []
+        self._collectors: List[Tuple[Callable[[], Dict[str, float]], frozenset]] = []
+
+    def register(self, metric: _Metric) -> _Metric:
+        self._metrics.append(metric)
+        return metric
+
+    def add_collector(self, collect: Callable[[], Dict[str, float]], counters: Iterable[str] = ()):
+        """Add a function returning {name: value}, called on every scrape.
+
+        Values are gauges, except `counters` (cumulative values).
+        """
+        self._collectors.append((collect, frozenset(counters)))
+
+    def render(self) -> str:
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        for collect, counters in self._collectors:
+            for name, value in collect().items():
+                lines.append(f'# TYPE {name} {"counter" if name in counters else "gauge"}')
+                lines.append(f'{name} {value}')
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+
+UPDATE_SECONDS = REGISTRY.register(Histogram(
+    'bot_update_seconds', 'Time of processing one update.'))
+FILTERS_SECONDS = REGISTRY.register(Histogram(
+    'bot_filters_seconds', 'Time of checking filters until a handler is found.', ['event', 'handler']))
+HANDLER_SECONDS = REGISTRY.register(Histogram(
+    'bot_handler_seconds', 'Time of running a handler.', ['event', 'handler']))
+MONGO_SECONDS = REGISTRY.register(Histogram(
+    'mongo_command_seconds', 'Time of Mongo commands.', ['collection', 'command']))
+MONGO_ERRORS = REGISTRY.register(Counter(
+    'mongo_command_errors_total', 'Failed Mongo commands.', ['collection', 'command']))
+BOT_API_SECONDS = REGISTRY.register(Histogram(
+    'bot_api_request_seconds', 'Time of Bot API requests.', ['method']))
+BOT_API_ERRORS = REGISTRY.register(Counter(
+    'bot_api_errors_total', 'Failed Bot API requests.', ['method', 'error']))
+
+_STARTED = '_metrics_started'
+_PROCESS = '_metrics_process'
+_HANDLER = '_metrics_handler'
+
+
+class MetricsMiddleware(BaseMiddleware):
+    """Time updates, filters and handlers.
+
+    Filters time is from pre_process to process (or post_process if nothing
+    matched, handler="unhandled"), handler time is from process to post_process.
+    """
+
+    async def trigger(self, action: str, args):
+        now = time.perf_counter()
+        data = args[-1]
+        if action.startswith('pre_process_'):
+            data[_STARTED] = now
+        elif action.startswith('process_'):
+            data[_PROCESS] = now
+            data[_HANDLER] = getattr(current_handler.get(None), '__name__', 'unknown')
+        elif action.startswith('post_process_'):
+            event = action[len('post_process_'):]
+            started = data.get(_STARTED)
+            if started is None:
+                return
+            if event == 'update':
+                UPDATE_SECONDS.labels().observe(now - started)
+                return
+            process = data.get(_PROCESS)
+            if process is None:
+                FILTERS_SECONDS.labels(event, 'unhandled').observe(now - started)
+            else:
+                handler = data[_HANDLER]
+                FILTERS_SECONDS.labels(event, handler).observe(process - started)
+                HANDLER_SECONDS.labels(event, handler).observe(now - process)
+
+
+class MongoListener(monitoring.CommandListener):
+    """Pass to the Mongo client as `event_listeners=[MongoListener()]`."""
+
+    def __init__(self):
+        self._collections: Dict[tuple, str] = {}
+
+    def started(self, event: monitoring.CommandStartedEvent):
+        value = event.command.get(event.command_name)
+        if event.command_name == 'getMore':
+            value = event.command.get('collection')
+        collection = value if isinstance(value, str) else ''
+        self._collections[(event.connection_id, event.request_id)] = collection
+
+    def succeeded(self, event: monitoring.CommandSucceededEvent):
+        collection = self._collections.pop((event.connection_id, event.request_id), '')
+        MONGO_SECONDS.labels(collection, event.command_name).observe(event.duration_micros / 1e6)
+
+    def failed(self, event: monitoring.CommandFailedEvent):
+        collection = self._collections.pop((event.connection_id, event.request_id), '')
+        MONGO_SECONDS.labels(collection, event.command_name).observe(event.duration_micros / 1e6)
+        MONGO_ERRORS.labels(collection, event.command_name).inc()
+
+
+class InstrumentedBot(Bot):
+    """Bot which times its API requests and counts errors (RetryAfter separately)."""
+
+    async def request(self, method: str, data: Optional[Dict] = None, files: Optional[Dict] = None, **kwargs):
+        started = time.perf_counter()
+        try:
+            return await super().request(method, data, files, **kwargs)
+        except RetryAfter:
+            BOT_API_ERRORS.labels(method, 'RetryAfter').inc()
+            raise
+        except TelegramAPIError as e:
+            BOT_API_ERRORS.labels(method, e.__class__.__name__).inc()
+            raise
+        finally:
+            BOT_API_SECONDS.labels(method).observe(time.perf_counter() - started)
+
+
+def setup(dp: Dispatcher):
+    dp.middleware.setup(MetricsMiddleware())
+
+
+async def start_server(port: int, host: str = '127.0.0.1') -> web.AppRunner:
+    """Serve `REGISTRY` on http://host:port/metrics."""
+    async def handle(_: web.Request) -> web.Response:
+        return web.Response(text=REGISTRY.render(), content_type='text/plain', charset='utf-8')
+
+    app = web.Application()
+    app.router.add_get('/metrics', handle)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    log.info('Metrics are served on http://%s:%s/metrics', host, port)
+    return runner
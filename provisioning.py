@@ -0,0 +1,152 @@
+"""Link pair chats of many deals at once.
+
+For every pair the invite links of both groups are exported concurrently
+through `sender` (so within flood limits, at most `concurrency` calls are
+queued at a time), then all chats are added
+with one insert_many and all projects are patched with one bulk_write.
+A failed pair doesn't stop the others, its error is returned in the result.
+"""
+import asyncio
+import logging
+from typing import List, NamedTuple, Optional
+
+from bson import ObjectId
+from bson.errors import InvalidId
+
+import data_classes
+from database_api import CHATS, PROJECTS
+from loader import bot, sender, users_db
+
+log = logging.getLogger(__name__)
+
+
+class Pair(NamedTuple):
+    project_id: str
+    client_id: int
+    worker_id: int
+    client_chat_id: int
+    worker_chat_id: int
+
+
+class PairResult(NamedTuple):
+    pair: Pair
+    chats: Optional[data_classes.PairChats] = None
+    error: Optional[Exception] = None
+
+    @property
+    def ok(self) -> bool:
+        return self.error is None
+
+
+class ProvisioningError(Exception):
+    pass
+
+
+async def _existing_projects(pairs: List[Pair]) -> set:
+    ids = []
+    for pair in pairs:
+        try:
+            ids.append(ObjectId(pair.project_id))
+        except (InvalidId, TypeError):
+            pass
+    projects = await users_db.get_object(PROJECTS, {'_id': {'$in': ids}}, many=True, projection={'_id': 1})
+    return {str(p['_id']) for p in projects}
+
+
+async def _make_chats(pair: Pair, semaphore: asyncio.Semaphore) -> data_classes.PairChats:
+    async def export_link(chat_id: int) -> str:
+        async with semaphore:
+            return await sender.call(chat_id, bot.export_chat_invite_link, chat_id)
+
+    client_link, worker_link = await asyncio.gather(export_link(pair.client_chat_id),
+                                                    export_link(pair.worker_chat_id))
+    return data_classes.PairChats(
+        client_chat=data_classes.Chat(pair.project_id, 'client', pair.client_id, client_link,
+                                      pair.worker_chat_id, pair.client_chat_id),
+        worker_chat=data_classes.Chat(pair.project_id, 'worker', pair.worker_id, worker_link,
+                                      pair.client_chat_id, pair.worker_chat_id),
+    )
+
+
+async def provision_pairs(pairs: List[Pair], status: str, concurrency: int = 20) -> List[PairResult]:
+    """Create chats of pairs and set project's chats, worker and `status`.
+
+    Return results in order of `pairs`. A pair fails if its project doesn't
+    exist or is given twice, a Bot API call fails or one of its groups is
+    already linked. If adding the chats or patching the projects fails, all
+    remaining pairs fail and their chats are removed.
+    """
+    results = {i: PairResult(pair) for i, pair in enumerate(pairs)}
+
+    def fail(i: int, error: Exception):
+        results[i] = PairResult(pairs[i], error=error)
+
+    projects = await _existing_projects(pairs)
+    used, used_projects = set(), set()
+    for i, pair in enumerate(pairs):
+        chat_ids = {pair.client_chat_id, pair.worker_chat_id}
+        if pair.project_id not in projects:
+            fail(i, ProvisioningError(f'Project {pair.project_id} not found'))
+        elif pair.project_id in used_projects:
+            fail(i, ProvisioningError(f'Project {pair.project_id} is used twice'))
+        elif len(chat_ids) < 2 or used & chat_ids:
+            fail(i, ProvisioningError(f'Chats {sorted(chat_ids)} are used twice'))
+        else:
+            used |= chat_ids
+            used_projects.add(pair.project_id)
+
+    semaphore = asyncio.Semaphore(concurrency)
+    pending = [i for i, result in results.items() if result.ok]
+    made = await asyncio.gather(*[_make_chats(pairs[i], semaphore) for i in pending], return_exceptions=True)
+    for i, chats in zip(pending, made):
+        if isinstance(chats, Exception):
+            fail(i, chats)
+        else:
+            results[i] = PairResult(pairs[i], chats)
+
+    pending = [i for i, result in results.items() if result.ok]
+    chats = [chat for i in pending for chat in (results[i].chats.client_chat, results[i].chats.worker_chat)]
+    try:
+        existing = set(await users_db.add_chats(chats))
+    except Exception as e:
+        log.exception('Cannot add chats of %s pairs, remove them', len(pending))
+        existing = set()
+        for i in pending:
+            fail(i, e)
+            # some chats may be inserted, don't touch the ones of other projects
+            for chat_id in (pairs[i].client_chat_id, pairs[i].worker_chat_id):
+                await users_db.delete_object(CHATS, {'_id': chat_id, 'project_id': pairs[i].project_id})
+    if existing:
+        # the other group of such pair was added, remove it
+        added = []
+        for i in pending:
+            pair = pairs[i]
+            linked = existing.intersection((pair.client_chat_id, pair.worker_chat_id))
+            if linked:
+                fail(i, ProvisioningError(f'Chats {sorted(linked)} are already linked'))
+                added.extend({pair.client_chat_id, pair.worker_chat_id} - linked)
+        await users_db.delete_objects(CHATS, added)
+
+    pending = [i for i, result in results.items() if result.ok]
+    try:
+        async with users_db.batch():
+            for i in pending:
+                pair = pairs[i]
+                await users_db.update_project_fields(pair.project_id, {
+                    'client_chat_id': pair.client_chat_id,
+                    'worker_chat_id': pair.worker_chat_id,
+                    'worker_id': pair.worker_id,
+                    'status': status,
+                })
+    except Exception as e:
+        log.exception('Cannot patch projects of %s pairs, remove their chats', len(pending))
+        for i in pending:
+            fail(i, e)
+        chat_ids = [chat_id for i in pending for chat_id in (pairs[i].client_chat_id, pairs[i].worker_chat_id)]
+        await users_db.delete_objects(CHATS, chat_ids)
+
+    failed = [r for r in results.values() if not r.ok]
+    if failed:
+        log.warning('Provisioned %s pairs, %s failed: %s', len(pairs) - len(failed), len(failed),
+                    [(r.pair.project_id, repr(r.error)) for r in failed[:10]])
+    return [results[i] for i in range(len(pairs))]
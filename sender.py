@@ -0,0 +1,211 @@
+"""Outbound Bot API scheduler with per-chat and global rate limits."""
+import asyncio
+import heapq
+import itertools
+import logging
+import time
+from collections import deque
+from dataclasses import dataclass, field
+from functools import partial
+from typing import Awaitable, Callable, Deque, Dict, List, Optional
+
+from aiogram.utils.exceptions import RetryAfter
+
+log = logging.getLogger(__name__)
+
+
+class Priority:
+    HIGH = 0
+    NORMAL = 1
+
+
+class TokenBucket:
+    """Allow `rate` calls per second with bursts up to `capacity`."""
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = capacity
+        self._updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def delay(self) -> float:
+        """Return seconds to wait until a token is available."""
+        self._refill()
+        if self._tokens >= 1:
+            return 0
+        return (1 - self._tokens) / self.rate
+
+    def is_full(self) -> bool:
+        self._refill()
+        return self._tokens >= self.capacity
+
+    def consume(self):
+        self._refill()
+        self._tokens -= 1
+
+
+@dataclass
+class _Request:
+    priority: int
+    seq: int
+    call: Callable[[], Awaitable]
+    future: asyncio.Future
+    created: float = field(default_factory=time.monotonic)
+    retries: int = 0
+
+
+class SendScheduler:
+    """Queue Bot API calls and send them without hitting Telegram flood limits.
+
+    Calls to one chat are sent strictly in FIFO order, chats are served by
+    priority of their oldest call. RetryAfter pauses the chat and retries the call.
+    If the bot runs in `processes` processes sending to the same chats, each
+    one gets an equal share of the limits.
+    """
+
+    def __init__(self, chat_rate: float = 20 / 60, chat_burst: float = 5,
+                 global_rate: float = 30, global_burst: float = 30,
+                 workers: int = 8, max_retries: int = 3, max_buckets: int = 10_000, processes: int = 1):
+        # a bucket needs capacity for at least one call
+        self.chat_rate = chat_rate / processes
+        self.chat_burst = max(1.0, chat_burst / processes)
+        self.max_retries = max_retries
+        self.max_buckets = max_buckets
+        self._workers_amount = workers
+        self._global = TokenBucket(global_rate / processes, max(1.0, global_burst / processes))
+
+        self._seq = itertools.count()
+        self._queues: Dict[int, Deque[_Request]] = {}
+        self._buckets: Dict[int, TokenBucket] = {}
+        self._ready: List[tuple] = []
+        self._wakeup: Optional[asyncio.Event] = None
+        self._workers: List[asyncio.Task] = []
+
+        self.sent = 0
+        self.failed = 0
+        self.retry_after = 0
+        self._wait_total = 0.0
+        self._wait_max = 0.0
+
+    def _start(self):
+        self._wakeup = asyncio.Event()
+        self._workers = [asyncio.create_task(self._work()) for _ in range(self._workers_amount)]
+
+    def _push(self, chat_id: int):
+        head = self._queues[chat_id][0]
+        heapq.heappush(self._ready, (head.priority, head.seq, chat_id))
+        self._wakeup.set()
+
+    async def call(self, chat_id: int, func: Callable[..., Awaitable], *args,
+                   priority: int = Priority.NORMAL, **kwargs):
+        """Schedule `func(*args, **kwargs)` as a send to `chat_id`, return its result."""
+        if not self._workers:
+            self._start()
+
+        future = asyncio.get_running_loop().create_future()
+        request = _Request(priority, next(self._seq), partial(func, *args, **kwargs), future)
+        queue = self._queues.setdefault(chat_id, deque())
+        queue.append(request)
+        if len(queue) == 1:
+            self._push(chat_id)
+        return await future
+
+    async def _work(self):
+        while True:
+            while not self._ready:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+            _, _, chat_id = heapq.heappop(self._ready)
+            try:
+                await self._process(chat_id)
+            except Exception:
+                log.exception('Cause exception while sending to %s', chat_id)
+
+    async def _process(self, chat_id: int):
+        loop = asyncio.get_running_loop()
+        queue = self._queues[chat_id]
+        request = queue[0]
+
+        bucket = self._buckets.get(chat_id)
+        if bucket is None:
+            bucket = self._buckets[chat_id] = TokenBucket(self.chat_rate, self.chat_burst)
+        delay = bucket.delay()
+        if delay:
+            loop.call_later(delay, self._push, chat_id)
+            return
+
+        delay = self._global.delay()
+        while delay:
+            await asyncio.sleep(delay)
+            delay = self._global.delay()
+        self._global.consume()
+        bucket.consume()
+
+        wait = time.monotonic() - request.created
+        try:
+            result = await request.call()
+        except RetryAfter as e:
+            self.retry_after += 1
+            request.retries += 1
+            if request.retries <= self.max_retries:
+                log.warning('Flood control for %s, retry in %s seconds', chat_id, e.timeout)
+                loop.call_later(e.timeout, self._push, chat_id)
+                return
+            self._finish(chat_id, request, wait, exception=e)
+        except Exception as e:
+            self._finish(chat_id, request, wait, exception=e)
+        else:
+            self._finish(chat_id, request, wait, result=result)
+
+    def _finish(self, chat_id: int, request: _Request, wait: float, result=None, exception=None):
+        queue = self._queues[chat_id]
+        queue.popleft()
+        if queue:
+            self._push(chat_id)
+        else:
+            del self._queues[chat_id]
+            if len(self._buckets) > self.max_buckets:
+                self._prune_buckets()
+
+        self._wait_total += wait
+        self._wait_max = max(self._wait_max, wait)
+        if exception is None:
+            self.sent += 1
+            if not request.future.done():
+                request.future.set_result(result)
+        else:
+            self.failed += 1
+            if not request.future.done():
+                request.future.set_exception(exception)
+
+    def _prune_buckets(self):
+        """Drop full buckets of idle chats, a new bucket is the same."""
+        for chat_id, bucket in list(self._buckets.items()):
+            if chat_id not in self._queues and bucket.is_full():
+                del self._buckets[chat_id]
+
+    def stats(self) -> dict:
+        done = self.sent + self.failed
+        return {
+            'queued': sum(len(q) for q in self._queues.values()),
+            'chats': len(self._queues),
+            'sent': self.sent,
+            'failed': self.failed,
+            'retry_after': self.retry_after,
+            'wait_avg': self._wait_total / done if done else 0.0,
+            'wait_max': self._wait_max,
+        }
+
+    async def close(self, timeout: float = 10):
+        """Wait for queued calls (at most `timeout` seconds), then stop workers."""
+        deadline = time.monotonic() + timeout
+        while self._queues and time.monotonic() < deadline:
+            await asyncio.sleep(0.05)
+        for worker in self._workers:
+            worker.cancel()
+        self._workers = []
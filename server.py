@@ -1,8 +1,15 @@
-"""Main script, starts bot in long-polling mode."""
+"""Main script, starts bot in long-polling mode.
+
+Updates of different chats are processed concurrently, updates of one chat
+in order (see `updates.OrderedDispatcher`).
+"""
 
 from aiogram import executor, Dispatcher
 
-from loader import dp
+import metrics
+from loader import METRICS_PORT, dp, sender, users_db
+
+DRAIN_TIMEOUT = 30
 
 
 async def on_startup(*_):
@@ -15,10 +22,26 @@ async def on_startup(*_):
     logger.info('Import %s', handlers)
     logger.info('Import %s', filters)
 
+    if METRICS_PORT:
+        metrics.setup(dp)
+        metrics.REGISTRY.add_collector(lambda: {f'sender_{k}': v for k, v in sender.stats().items()},
+                                       counters=['sender_sent', 'sender_failed', 'sender_retry_after'])
+        for name in ('chats_cache', 'messages_cache', 'entities_cache'):
+            cache = getattr(users_db, name)
+            metrics.REGISTRY.add_collector(lambda n=name, c=cache: {f'{n}_{k}': v for k, v in c.stats().items()},
+                                           counters=[f'{name}_hits', f'{name}_misses'])
+        await metrics.start_server(int(METRICS_PORT))
+
 
 async def on_shutdown(dispatcher: Dispatcher):
+    from handlers.dialog import album_buffer
+
+    await dispatcher.processor.close(DRAIN_TIMEOUT)
+    await album_buffer.close()
+    await sender.close()
     await dispatcher.storage.close()
     await dispatcher.storage.wait_closed()
+    await users_db.close()
 
 
 if __name__ == '__main__':
@@ -0,0 +1,123 @@
+"""Admin statistics computed by Mongo aggregations and cached for a short time."""
+import asyncio
+from datetime import datetime, timedelta
+from functools import partial
+from typing import Awaitable, Callable, Dict, Hashable, Optional
+
+from bson import ObjectId
+
+from cache import MISSING, TTLCache
+from database_api import ACCOUNTS, PROJECTS, MongoDB
+
+# projects with a worker are counted as deals
+DEAL = {'worker_id': {'$ne': None}}
+
+
+def _created_filter(since: Optional[datetime], until: Optional[datetime] = None) -> dict:
+    created = {}
+    if since:
+        created['$gte'] = ObjectId.from_datetime(since)
+    if until:
+        created['$lt'] = ObjectId.from_datetime(until)
+    return {'_id': created} if created else {}
+
+
+def _counts(groups: list) -> Dict[str, int]:
+    return {g['_id']: g['count'] for g in groups}
+
+
+class Statistics:
+    """Statistics of projects and accounts.
+
+    Results are cached for `ttl` seconds, concurrent requests for the same
+    statistic wait for one aggregation.
+    """
+
+    def __init__(self, db: MongoDB, ttl: float = 30, maxsize: int = 256):
+        self.db = db
+        self.cache = TTLCache(maxsize, ttl)
+        self._computing: Dict[Hashable, asyncio.Future] = {}
+
+    async def _cached(self, key: Hashable, compute: Callable[[], Awaitable]):
+        result = self.cache.get(key)
+        if result is not MISSING:
+            return result
+        future = self._computing.get(key)
+        if future is None:
+            future = self._computing[key] = asyncio.ensure_future(compute())
+            future.add_done_callback(partial(self._computed, key))
+        return await asyncio.shield(future)
+
+    def _computed(self, key: Hashable, future: asyncio.Future):
+        del self._computing[key]
+        if not future.cancelled() and future.exception() is None:
+            self.cache.set(key, future.result())
+
+    async def projects_by_status(self) -> Dict[str, int]:
+        async def compute():
+            pipeline = [{'$group': {'_id': '$status', 'count': {'$sum': 1}}}]
+            return _counts(await self.db.aggregate(PROJECTS, pipeline))
+        return await self._cached('projects_by_status', compute)
+
+    async def projects_by_subject(self, status: str = None) -> Dict[str, int]:
+        """Return {subject: amount of projects}, most popular first."""
+        async def compute():
+            pipeline = [
+                {'$match': {'status': status} if status else {}},
+                {'$group': {'_id': '$data.subject', 'count': {'$sum': 1}}},
+                {'$sort': {'count': -1}},
+            ]
+            return _counts(await self.db.aggregate(PROJECTS, pipeline))
+        return await self._cached(('projects_by_subject', status), compute)
+
+    async def revenue(self, since: datetime = None, until: datetime = None) -> dict:
+        """Return {'total': sum of deal prices, 'deals': amount, 'average': price}."""
+        async def compute():
+            pipeline = [
+                {'$match': {**DEAL, **_created_filter(since, until)}},
+                {'$group': {'_id': None, 'total': {'$sum': '$data.price'}, 'deals': {'$sum': 1},
+                            'average': {'$avg': '$data.price'}}},
+                {'$project': {'_id': 0}},
+            ]
+            result = await self.db.aggregate(PROJECTS, pipeline)
+            return result[0] if result else {'total': 0, 'deals': 0, 'average': None}
+        return await self._cached(('revenue', since, until), compute)
+
+    async def active_users(self, days: int = 30) -> dict:
+        """Return amounts of workers and clients with projects in last `days`."""
+        async def compute():
+            since = _created_filter(datetime.utcnow() - timedelta(days=days))
+            pipeline = [
+                {'$match': since},
+                {'$facet': {
+                    'workers': [{'$match': DEAL}, {'$group': {'_id': '$worker_id'}}, {'$count': 'count'}],
+                    'clients': [{'$group': {'_id': '$client_id'}}, {'$count': 'count'}],
+                }},
+            ]
+            result = (await self.db.aggregate(PROJECTS, pipeline))[0]
+            return {name: counts[0]['count'] if counts else 0 for name, counts in result.items()}
+        return await self._cached(('active_users', days), compute)
+
+    async def accounts(self) -> dict:
+        """Return amounts of all accounts and of workers subscribed to any subject."""
+        async def compute():
+            pipeline = [{'$group': {
+                '_id': None,
+                'total': {'$sum': 1},
+                'workers': {'$sum': {'$cond': [{'$gt': [{'$size': {'$ifNull': ['$subjects', []]}}, 0]}, 1, 0]}},
+            }}, {'$project': {'_id': 0}}]
+            result = await self.db.aggregate(ACCOUNTS, pipeline)
+            return result[0] if result else {'total': 0, 'workers': 0}
+        return await self._cached('accounts', compute)
+
+    async def summary(self, days: int = 30) -> dict:
+        """All statistics for the admin dashboard, computed concurrently."""
+        keys = ('projects_by_status', 'projects_by_subject', 'revenue', 'active_users', 'accounts')
+        values = await asyncio.gather(
+            self.projects_by_status(),
+            self.projects_by_subject(),
+            self.revenue(),
+            self.active_users(days),
+            self.accounts(),
+        )
+        return dict(zip(keys, values))
@@ -0,0 +1,168 @@
+"""Concurrent processing of updates, ordered within each chat."""
+import asyncio
+import logging
+from collections import deque
+from typing import Deque, Dict, Optional, Set, Union
+
+import aiohttp
+from aiogram import Bot, Dispatcher, types
+from aiohttp.helpers import sentinel
+
+log = logging.getLogger(__name__)
+
+
+def update_chat_id(update: types.Update) -> Optional[int]:
+    """Return id of the chat the update belongs to, None for other update types."""
+    msg = (update.message or update.edited_message
+           or update.channel_post or update.edited_channel_post)
+    if msg:
+        return msg.chat.id
+    if update.callback_query:
+        if update.callback_query.message:
+            return update.callback_query.message.chat.id
+        return update.callback_query.from_user.id
+    return None
+
+
+def raw_update_chat_id(update: dict) -> Optional[int]:
+    """Same as `update_chat_id` for not parsed update (e.g. webhook request body)."""
+    for key in ('message', 'edited_message', 'channel_post', 'edited_channel_post'):
+        if key in update:
+            return update[key]['chat']['id']
+    query = update.get('callback_query')
+    if query:
+        if 'message' in query:
+            return query['message']['chat']['id']
+        return query['from']['id']
+    return None
+
+
+class ChatOrderedProcessor:
+    """Process updates of different chats concurrently, of one chat - one by one.
+
+    At most `concurrency` updates are handled at the same time and at most
+    `max_pending` are accepted, `submit` waits for room after that.
+    """
+
+    def __init__(self, dispatcher: Dispatcher, concurrency: int = 32, max_pending: int = 1000):
+        self.dispatcher = dispatcher
+        self.concurrency = concurrency
+        self.max_pending = max_pending
+
+        self._queues: Dict[Union[int, None], Deque[types.Update]] = {}
+        self._handling: Optional[asyncio.Semaphore] = None
+        self._room: Optional[asyncio.Semaphore] = None
+        self._idle: Optional[asyncio.Event] = None
+        # the loop keeps only weak references to tasks
+        self._tasks: Set[asyncio.Task] = set()
+
+    @property
+    def pending(self) -> int:
+        return sum(len(q) for q in self._queues.values())
+
+    async def submit(self, update: types.Update):
+        """Queue update behind the previous updates of its chat."""
+        if self._room is None:
+            self._handling = asyncio.Semaphore(self.concurrency)
+            self._room = asyncio.Semaphore(self.max_pending)
+            self._idle = asyncio.Event()
+        await self._room.acquire()
+
+        chat_id = update_chat_id(update)
+        queue = self._queues.get(chat_id)
+        if queue is None:
+            self._queues[chat_id] = deque([update])
+            self._idle.clear()
+            task = asyncio.create_task(self._run(chat_id))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+        else:
+            queue.append(update)
+
+    async def _run(self, chat_id: Optional[int]):
+        queue = self._queues[chat_id]
+        while queue:
+            update = queue[0]
+            async with self._handling:
+                try:
+                    await self.dispatcher.updates_handler.notify(update)
+                except Exception:
+                    log.exception('Cause exception while processing update %s', update.update_id)
+            queue.popleft()
+            self._room.release()
+
+        del self._queues[chat_id]
+        if not self._queues:
+            self._idle.set()
+
+    async def join(self, timeout: Optional[float] = None):
+        """Wait until all accepted updates are processed (at most `timeout` seconds)."""
+        if self._idle is None or not self._queues:
+            return
+        try:
+            await asyncio.wait_for(asyncio.shield(self._idle.wait()), timeout)
+        except asyncio.TimeoutError:
+            log.warning('%s updates are not processed in %s seconds.', self.pending, timeout)
+
+    async def close(self, timeout: Optional[float] = None):
+        """Wait for accepted updates (at most `timeout` seconds), then cancel the rest."""
+        await self.join(timeout)
+        tasks = list(self._tasks)
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+
+class OrderedDispatcher(Dispatcher):
+    """Dispatcher which long-polls into `ChatOrderedProcessor`.
+
+    Polling waits while the processor is full, so memory stays bounded.
+    """
+
+    def __init__(self, *args, concurrency: int = 32, max_pending: int = 1000, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.processor = ChatOrderedProcessor(self, concurrency, max_pending)
+
+    async def start_polling(self, timeout=20, relax=0.1, limit=None, reset_webhook=None,
+                            fast: Optional[bool] = True, error_sleep: int = 5):
+        if self._polling:
+            raise RuntimeError('Polling already started')
+
+        log.info('Start ordered polling.')
+        Dispatcher.set_current(self)
+        Bot.set_current(self.bot)
+
+        if reset_webhook is None:
+            await self.reset_webhook(check=False)
+        if reset_webhook:
+            await self.reset_webhook(check=True)
+
+        self._polling = True
+        offset = None
+        try:
+            request_timeout = None
+            if self.bot.timeout is not sentinel and timeout is not None:
+                request_timeout = aiohttp.ClientTimeout(total=self.bot.timeout.total + timeout or 1)
+
+            while self._polling:
+                try:
+                    with self.bot.request_timeout(request_timeout):
+                        updates = await self.bot.get_updates(limit=limit, offset=offset, timeout=timeout)
+                except asyncio.CancelledError:
+                    break
+                except Exception:
+                    log.exception('Cause exception while getting updates.')
+                    await asyncio.sleep(error_sleep)
+                    continue
+
+                if updates:
+                    log.debug('Received %s updates.', len(updates))
+                    offset = updates[-1].update_id + 1
+                    for update in updates:
+                        await self.processor.submit(update)
+
+                if relax:
+                    await asyncio.sleep(relax)
+        finally:
+            self._close_waiter.set_result(None)
+            log.warning('Polling is stopped.')
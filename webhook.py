@@ -0,0 +1,139 @@
+"""Starts bot in webhook mode with several worker processes.
+
+The front process receives updates from Telegram and passes each one to a
+worker chosen by consistent hashing of its chat id, so updates of one chat
+are always handled (in order) by the same worker, with its own caches.
+
+    python webhook.py --url https://example.com/bot --port 8080 --workers 4
+"""
+import argparse
+import asyncio
+import bisect
+import hashlib
+import logging
+import multiprocessing
+import os
+from typing import List, Optional
+
+from aiohttp import ClientSession, web
+
+from updates import raw_update_chat_id
+
+WORKER_HOST = '127.0.0.1'
+
+log = logging.getLogger(__name__)
+
+
+class HashRing:
+    """Consistent hashing of keys to nodes (with virtual nodes)."""
+
+    def __init__(self, nodes: List[str], replicas: int = 100):
+        self._ring = sorted((self._hash(f'{node}#{i}'), node) for node in nodes for i in range(replicas))
+        self._hashes = [h for h, _ in self._ring]
+
+    @staticmethod
+    def _hash(key: str) -> int:
+        return int.from_bytes(hashlib.md5(key.encode()).digest()[:8], 'big')
+
+    def get(self, key) -> str:
+        index = bisect.bisect(self._hashes, self._hash(str(key))) % len(self._ring)
+        return self._ring[index][1]
+
+
+def run_worker(port: int, index: int = 0, workers: int = 1):
+    """Worker process: accept updates from the front and process them."""
+    # every worker sends to any chat (e.g. pair chats of another worker), so they share the flood limits
+    os.environ['SENDER_PROCESSES'] = str(workers)
+    if os.getenv('METRICS_PORT'):
+        # each worker serves its own metrics on the next port
+        os.environ['METRICS_PORT'] = str(int(os.environ['METRICS_PORT']) + index)
+
+    from aiogram import Bot, Dispatcher, types
+
+    import server
+    from loader import dp
+
+    async def handle(request: web.Request) -> web.Response:
+        Dispatcher.set_current(dp)
+        Bot.set_current(dp.bot)
+        update = types.Update(**await request.json())
+        await dp.processor.submit(update)
+        return web.Response()
+
+    async def on_startup(_):
+        await server.on_startup(dp)
+
+    async def on_cleanup(_):
+        # requests are finished here, drain accepted updates and close storage
+        await server.on_shutdown(dp)
+        await dp.bot.session.close()
+
+    app = web.Application()
+    app.router.add_post('/', handle)
+    app.on_startup.append(on_startup)
+    app.on_cleanup.append(on_cleanup)
+    web.run_app(app, host=WORKER_HOST, port=port, print=None, access_log=None)
+
+
+def create_front(worker_urls: List[str], webhook_path: str,
+                 webhook_url: Optional[str] = None) -> web.Application:
+    """Front app: route each update to its worker."""
+    ring = HashRing(worker_urls)
+    app = web.Application()
+
+    async def handle(request: web.Request) -> web.Response:
+        body = await request.read()
+        update = await request.json()
+        url = ring.get(raw_update_chat_id(update))
+        async with app['session'].post(url, data=body, headers={'Content-Type': 'application/json'}) as resp:
+            return web.Response(status=resp.status)
+
+    async def on_startup(_):
+        app['session'] = ClientSession()
+        if webhook_url:
+            from loader import bot
+            await bot.set_webhook(webhook_url)
+            await bot.session.close()
+
+    async def on_cleanup(_):
+        await app['session'].close()
+
+    app.router.add_post(webhook_path, handle)
+    app.on_startup.append(on_startup)
+    app.on_cleanup.append(on_cleanup)
+    return app
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--url', help='public webhook url, set on start if given')
+    parser.add_argument('--path', default='/', help='path of webhook requests')
+    parser.add_argument('--host', default='0.0.0.0')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--workers', type=int, default=multiprocessing.cpu_count())
+    parser.add_argument('--workers-port', type=int, default=8100, help='port of the first worker')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=20)
+    ctx = multiprocessing.get_context('spawn')
+    ports = [args.workers_port + i for i in range(args.workers)]
+    workers = [ctx.Process(target=run_worker, args=(port, i, args.workers), daemon=False)
+               for i, port in enumerate(ports)]
+    for worker in workers:
+        worker.start()
+
+    async def stop_workers(_):
+        # front has stopped accepting and finished its requests
+        for worker in workers:
+            worker.terminate()
+        for worker in workers:
+            await asyncio.get_running_loop().run_in_executor(None, worker.join)
+        log.info('Workers are stopped.')
+
+    app = create_front([f'http://{WORKER_HOST}:{port}/' for port in ports], args.path, args.url)
+    app.on_cleanup.append(stop_workers)
+    web.run_app(app, host=args.host, port=args.port)
+
+
+if __name__ == '__main__':
+    main()